@@ -1,22 +1,35 @@
 from collections import defaultdict
 
+from .models import get_group_perms
+
 
 class GroupPermWrapper(object):
+    """
+    Template access to the permissions of a group. These aren't loaded until the first lookup, so pages which never
+    check them don't pay for them.
+    """
+
     def __init__(self, group):
         self.group = group
         self.empty = defaultdict(lambda: False)
+        self._apps = None
+
+    @property
+    def apps(self):
+        if self._apps is None:
+            self._apps = dict()
+            if self.group:
+                for perm in get_group_perms(self.group):
+                    app_name, codename = perm.split(".", 1)
+                    app_perms = self._apps.get(app_name, None)
 
-        self.apps = dict()
-        if self.group:
-            for perm in self.group.permissions.all().select_related("content_type"):
-                app_name = perm.content_type.app_label
-                app_perms = self.apps.get(app_name, None)
+                    if not app_perms:
+                        app_perms = defaultdict(lambda: False)
+                        self._apps[app_name] = app_perms
 
-                if not app_perms:
-                    app_perms = defaultdict(lambda: False)
-                    self.apps[app_name] = app_perms
+                    app_perms[codename] = True
 
-                app_perms[perm.codename] = True
+        return self._apps
 
     def __getitem__(self, module_name):
         return self.apps.get(module_name, self.empty)
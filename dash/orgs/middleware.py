@@ -1,9 +1,19 @@
 import re
+import threading
+import time
 import traceback
-from contextlib import nullcontext
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
 
 from django.conf import settings
 from django.core.exceptions import DisallowedHost
+from django.core.signals import setting_changed
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.db.models.functions import Lower
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.utils import timezone, translation
@@ -42,65 +52,219 @@ ALLOW_NO_ORG = (
     "orgs.orgbackend_update",
 )
 
+IP_REGEX = re.compile(r"^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$")
+
+# how many hosts we cache the parsed parts and resolved org for in each process
+HOST_CACHE_MAX_SIZE = 1000
+
+# normalized host -> (org id or none, expiry time)
+_host_cache = {}
+_host_cache_lock = threading.Lock()
+
+
+def get_cached_host(host):
+    with _host_cache_lock:
+        cached = _host_cache.get(host)
+
+    if cached and cached[1] > time.monotonic():
+        return True, cached[0]
+    return False, None
+
+
+def set_cached_host(host, org_id):
+    ttl = getattr(settings, "SITE_HOST_CACHE_TTL", 60)
+    if not ttl:
+        return
+
+    with _host_cache_lock:
+        if len(_host_cache) >= HOST_CACHE_MAX_SIZE:
+            _host_cache.clear()
+
+        _host_cache[host] = (org_id, time.monotonic() + ttl)
+
+
+@receiver(post_save, sender=Org, dispatch_uid="dash.orgs.middleware.org_saved")
+@receiver(post_delete, sender=Org, dispatch_uid="dash.orgs.middleware.org_deleted")
+def clear_host_cache(**kwargs):
+    with _host_cache_lock:
+        _host_cache.clear()
+
+
+@receiver(setting_changed, dispatch_uid="dash.orgs.middleware.setting_changed")
+def clear_host_cache_on_setting_changed(setting, **kwargs):
+    if setting in ("HOSTNAME", "SITE_HOST_CACHE_TTL"):
+        clear_host_cache()
+
+    if setting == "HOSTNAME":
+        get_host_settings.cache_clear()
+        subdomain_from_host_parts.cache_clear()
+
 
 class SetOrgMiddleware(MiddlewareMixin):
     """
-    Sets the org on the request, based on the subdomain
+    Sets the org on the request, based on the subdomain. Under ASGI this runs in async mode, resolving the org with
+    async queries rather than running the whole middleware in a thread.
     """
 
-    async_capable = False
+    async_capable = True
 
     def __init__(self, get_response=None):
         super(SetOrgMiddleware, self).__init__(get_response)
 
     def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
         response = self.process_request(request)
         if response:
             return response
 
-        org = request.org
+        with self.org_overrides(request.org):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        response = await self.aprocess_request(request)
+        if response:
+            return response
 
-        # activate the org's language and timezone for the duration of the request only, restoring whatever was
-        # active before so that state never leaks into subsequent requests on the same thread, and org-less
-        # requests keep e.g. the language negotiated by LocaleMiddleware
+        # the overrides are stored in context variables so only apply to this request's context
+        with self.org_overrides(request.org):
+            return await self.get_response(request)
+
+    @contextmanager
+    def org_overrides(self, org):
+        """
+        Activates the org's language and timezone for the duration of the request only, restoring whatever was active
+        before so that state never leaks into subsequent requests on the same thread, and org-less requests keep e.g.
+        the language negotiated by LocaleMiddleware
+        """
         lang_override = translation.override(org.language or settings.DEFAULT_LANGUAGE) if org else nullcontext()
         tz_override = timezone.override(org.timezone) if org and org.timezone else nullcontext()
 
         with lang_override, tz_override:
-            return self.get_response(request)
+            yield
 
     def process_request(self, request):
+        org = self.get_org(request)
 
-        # try looking the domain level
-        host_parts = self.get_host_parts(request)
+        if not request.user.is_anonymous:
+            request.user.set_org(org)
 
-        org = None
-        # the domain is something like 'ureport.bi' or 'ureport.co.ug'
-        if len(host_parts) >= 2:
-            # we might have a three part domain like 'ureport.co.ug'
-            domain = ".".join(host_parts[-3:])
-            org = Org.objects.filter(domain__iexact=domain, is_active=True).first()
+        request.org = org
 
-            if not org:
-                # try now the two last part for domains like 'ureport.bi'
-                domain = ".".join(host_parts[-2:])
-                org = Org.objects.filter(domain__iexact=domain, is_active=True).first()
+    async def aprocess_request(self, request):
+        """
+        Async version of process_request. A subclass which overrides process_request has it run in a thread here, so
+        that it isn't bypassed under ASGI.
+        """
+        if type(self).process_request is not SetOrgMiddleware.process_request:
+            return await sync_to_async(self.process_request)(request)
 
+        org = await self.aget_org(request)
+
+        user = await request.auser()
+        if not user.is_anonymous:
+            user.set_org(org)
+
+        request.user = user  # so that sync code sees the same user instance
+        request.org = org
+
+    def get_org(self, request):
+        """
+        Gets the org for the request's host. Which org a host resolves to is cached in this process for
+        SITE_HOST_CACHE_TTL seconds (or until any org is saved or deleted), leaving just a primary key lookup.
+        """
+        host = self.get_host_key(request)
+
+        cached_orgs = self.get_cached_orgs(host)
+        if cached_orgs is not None:
+            org = cached_orgs.first()
+            if org or cached_orgs.query.is_empty():
+                return org
+
+        org = self.resolve_org(request)
+        set_cached_host(host, org.pk if org else None)
+        return org
+
+    async def aget_org(self, request):
+        """
+        Async version of get_org. A subclass which overrides get_org has it run in a thread here, as with resolve_org.
+        """
+        if type(self).get_org is not SetOrgMiddleware.get_org:
+            return await sync_to_async(self.get_org)(request)
+
+        host = self.get_host_key(request)
+
+        cached_orgs = self.get_cached_orgs(host)
+        if cached_orgs is not None:
+            org = await cached_orgs.afirst()
+            if org or cached_orgs.query.is_empty():
+                return org
+
+        org = await self.aresolve_org(request)
+        set_cached_host(host, org.pk if org else None)
+        return org
+
+    def get_host_key(self, request):
+        return ".".join(self.get_host_parts(request)).lower()
+
+    def get_cached_orgs(self, host):
+        """
+        Gets the cached resolution of the given host as a queryset, or none if it isn't cached. Hosts cached as
+        resolving to no org give an empty queryset which is answered without a query. Otherwise the queryset finds
+        the cached org, or nothing if that org has been deactivated since, in which case the host is resolved again.
+        """
+        is_cached, org_id = get_cached_host(host)
+        if not is_cached:
+            return None
+
+        return Org.objects.filter(pk=org_id, is_active=True) if org_id is not None else Org.objects.none()
+
+    def resolve_org(self, request):
+        """
+        Resolves the org for the request's host when it isn't cached
+        """
+        return self.get_org_candidates(request).first()
+
+    async def aresolve_org(self, request):
+        """
+        Async version of resolve_org. A subclass which only overrides resolve_org has it run in a thread here, so that
+        it resolves orgs the same way under ASGI as under WSGI.
+        """
+        if type(self).resolve_org is not SetOrgMiddleware.resolve_org:
+            return await sync_to_async(self.resolve_org)(request)
+
+        return await self.get_org_candidates(request).afirst()
+
+    def get_org_candidates(self, request):
+        """
+        Gets the orgs which the request's host could resolve to, in order of priority, for resolving with a single
+        query. A custom domain matching the last three parts of the host takes priority, then one matching the last two
+        parts (or the only part), and then the subdomain.
+        """
+        host_parts = self.get_host_parts(request)
+
+        # the domain is something like 'ureport.bi' or 'ureport.co.ug', or a single part like 'localhost'
+        domains = []
+        if len(host_parts) >= 2:
+            domains = [".".join(host_parts[-3:]), ".".join(host_parts[-2:])]
         elif host_parts:
-            # we have a domain like 'localhost'
-            domain = host_parts[0]
-            org = Org.objects.filter(domain__iexact=domain, is_active=True).first()
+            domains = [host_parts[0]]
 
-        # no custom domain found, try the subdomain
-        if not org:
-            subdomain = self.get_subdomain(request)
+        subdomain = self.get_subdomain(request)
 
-            org = Org.objects.filter(subdomain__iexact=subdomain, is_active=True).first()
+        priorities = [When(lower_domain=d.lower(), then=Value(p)) for p, d in enumerate(domains)]
+        priorities.append(When(lower_subdomain=subdomain.lower(), then=Value(len(domains))))
 
-        if not request.user.is_anonymous:
-            request.user.set_org(org)
+        candidates = Org.objects.filter(is_active=True).alias(
+            lower_domain=Lower("domain"), lower_subdomain=Lower("subdomain")
+        )
+        candidates = candidates.filter(
+            Q(lower_domain__in=[d.lower() for d in domains]) | Q(lower_subdomain=subdomain.lower())
+        )
+        candidates = candidates.alias(priority=Case(*priorities, output_field=IntegerField()))
 
-        request.org = org
+        return candidates.order_by("priority", "name", "pk")
 
     def process_view(self, request, view_func, view_args, view_kwargs):
         if not request.org:
@@ -126,58 +290,70 @@ class SetOrgMiddleware(MiddlewareMixin):
                 return HttpResponseRedirect(reverse(chooser_view))
 
     def get_host_parts(self, request):
-        host = "localhost"
-        try:
-            host = request.get_host()
-        except DisallowedHost:
-            traceback.print_exc()
+        # parsed once per request as both the org lookup and get_subdomain need them
+        parts = getattr(request, "_host_parts", None)
+        if parts is None:
+            host = "localhost"
+            try:
+                host = request.get_host()
+            except DisallowedHost:
+                traceback.print_exc()
 
-        # does the host look like an IP? return []
-        if re.match(r"^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$", host):
-            return []
+            parts = request._host_parts = split_host(host)
 
-        return host.split(".")
+        return list(parts)
 
     def get_subdomain(self, request):
+        return subdomain_from_host_parts(tuple(self.get_host_parts(request)))
 
-        subdomain = ""
-        parts = self.get_host_parts(request)
-        host_string = ".".join(parts)
-
-        # we only look up subdomains for localhost and the configured hostname only
-        top_domains = ["localhost:8000", "localhost", getattr(settings, "HOSTNAME", "")]
-        allowed_top_domain = False
-        for top in top_domains:
-            if host_string.endswith(top):
-                allowed_top_domain = True
-                break
-
-        # if empty parts or domain neither localhost nor hostname return ""
-        if not parts or not allowed_top_domain:
-            return subdomain
-
-        # if we have parts for domain like 'www.nigeria.ureport.in'
-        if len(parts) > 2:
-            subdomain = parts[0]
-            parts = parts[1:]
 
-            # we keep stripping subdomains if the subdomain is something
-            # like 'www' and there are more parts
-            while subdomain.lower() == "www" and len(parts) > 1:
-                subdomain = parts[0]
-                parts = parts[1:]
+@lru_cache(maxsize=1)
+def get_host_settings():
+    """
+    Gets the top domains we look up subdomains for, and the first part of the configured hostname
+    """
+    hostname = getattr(settings, "HOSTNAME", "")
+    return ("localhost:8000", "localhost", hostname), hostname.lower().split(".")[0]
 
-        elif len(parts) > 0:
-            # for domains like 'ureport.in' we just take the first part
-            subdomain = parts[0]
 
-        # get the configured hostname
-        hostname = getattr(settings, "HOSTNAME", "")
-        domain_first_part = hostname.lower().split(".")[0]
+@lru_cache(maxsize=HOST_CACHE_MAX_SIZE)
+def split_host(host):
+    # does the host look like an IP? return no parts
+    if IP_REGEX.match(host):
+        return ()
+
+    return tuple(host.split("."))
 
-        # if the subdomain is the same as the first part of hostname
-        # ignore than and return ''
-        if subdomain.lower() in [domain_first_part, "localhost"]:
-            subdomain = ""
 
+@lru_cache(maxsize=HOST_CACHE_MAX_SIZE)
+def subdomain_from_host_parts(parts):
+    subdomain = ""
+    host_string = ".".join(parts)
+    top_domains, domain_first_part = get_host_settings()
+
+    # if empty parts or domain neither localhost nor hostname return ""
+    # we only look up subdomains for localhost and the configured hostname only
+    if not parts or not host_string.endswith(top_domains):
         return subdomain
+
+    # if we have parts for domain like 'www.nigeria.ureport.in'
+    if len(parts) > 2:
+        subdomain = parts[0]
+        parts = parts[1:]
+
+        # we keep stripping subdomains if the subdomain is something
+        # like 'www' and there are more parts
+        while subdomain.lower() == "www" and len(parts) > 1:
+            subdomain = parts[0]
+            parts = parts[1:]
+
+    elif len(parts) > 0:
+        # for domains like 'ureport.in' we just take the first part
+        subdomain = parts[0]
+
+    # if the subdomain is the same as the first part of hostname
+    # ignore than and return ''
+    if subdomain.lower() in [domain_first_part, "localhost"]:
+        subdomain = ""
+
+    return subdomain
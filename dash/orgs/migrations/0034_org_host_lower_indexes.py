@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:08
+
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orgs", "0033_rename_orgs_orgbac_org_id_607508_idx_orgs_orgbac_org_slug_idx_and_more"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="org",
+            index=models.Index(django.db.models.functions.text.Lower("domain"), name="orgs_org_domain_lower_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="org",
+            index=models.Index(django.db.models.functions.text.Lower("subdomain"), name="orgs_org_subdomain_lower_idx"),
+        ),
+    ]
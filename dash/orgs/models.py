@@ -1,18 +1,27 @@
 import json
-from functools import partial
+import threading
+import time
+from functools import lru_cache, partial
 from pydoc import locate
+from uuid import uuid4
 
 from smartmin.models import SmartModel
 from temba_client.v2 import TembaClient
 from timezone_field import TimeZoneField
 
 from django.conf import settings
-from django.contrib.auth.models import Group, User
-from django.db import models, transaction
+from django.contrib.auth.models import Group, Permission, User
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, connection, models, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Lower
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from dash.utils import generate_file_path, random_string
+from dash.utils import generate_file_path, get_cacheable, random_string
 from dash.utils.email import send_dash_email
 
 STATE = 1
@@ -25,6 +34,27 @@ BOUNDARY_CACHE_KEY = "org:%d:boundaries"
 BOUNDARY_LEVEL_1_KEY = "geojson:%d"
 BOUNDARY_LEVEL_2_KEY = "geojson:%d:%s"
 
+# we cache which role each user has in each org, invalidated when org memberships change
+USER_ROLE_CACHE_TIME = getattr(settings, "ORG_USER_ROLE_CACHE_TIME", 60 * 60)
+USER_ROLE_CACHE_KEY = "org:%d:user:%d:role"
+
+# the roles a user can have in an org, by the org relation and group that they correspond to, in order of precedence
+ROLE_ADMINISTRATOR = "A"
+ROLE_EDITOR = "E"
+ROLE_VIEWER = "V"
+ORG_ROLES = (
+    (ROLE_ADMINISTRATOR, "administrators", "Administrators"),
+    (ROLE_EDITOR, "editors", "Editors"),
+    (ROLE_VIEWER, "viewers", "Viewers"),
+)
+
+# we cache what the org chooser page needs to list active orgs, invalidated when orgs change
+CHOOSER_CACHE_TIME = getattr(settings, "SITE_CHOOSER_CACHE_TIME", 60 * 60)
+CHOOSER_CACHE_KEY = "org:chooser"
+
+# how long we cache the permissions of each group in each process
+GROUP_PERMS_CACHE_TTL = getattr(settings, "GROUP_PERMS_CACHE_TTL", 60 * 5)
+
 
 class Org(SmartModel):
     name = models.CharField(verbose_name=_("Name"), max_length=128, help_text=_("The name of this organization"))
@@ -93,40 +123,79 @@ class Org(SmartModel):
         return locate(backend.backend_type)(backend=backend)
 
     def get_config(self, name, default=None):
-        config = getattr(self, "_config", None)
+        return self._lookup_config(self._get_config_path(name), default)
 
-        if config is None:
-            if not self.config:
-                return default
+    def get_configs(self, names, default=None):
+        """
+        Gets several config values at once, as a dict of the given names to their values
+        """
+        return {name: self._lookup_config(self._get_config_path(name), default) for name in names}
 
-            config = self.config
-            self._config = config
+    def set_config(self, name, value, commit=True):
+        self.set_configs({name: value}, commit=commit)
 
-        if name.find(".") == -1:
-            name = "common.%s" % name
+    def set_configs(self, values, commit=True):
+        """
+        Sets several config values at once. If committing, only the given keys of the config column are written, so
+        concurrent updates of other keys aren't overwritten. On PostgreSQL this is an update query rather than a save,
+        but pre_save and post_save are still sent with update_fields={"config"} as they would be by a save.
+        """
+        if not self.config:
+            self.config = dict()
 
-        key1, key2 = name.split(".", 1)
-        return config.get(key1, dict()).get(key2, default)
+        values = {self._get_config_path(name): value for name, value in values.items()}
 
-    def set_config(self, name, value, commit=True):
-        if not self.config:
-            config = dict()
-        else:
-            config = self.config
+        for (key1, key2), value in values.items():
+            self.config.setdefault(key1, dict())[key2] = value
 
-        if name.find(".") == -1:
-            name = "common.%s" % name
-        key1, key2 = name.split(".", 1)
+        if commit:
+            if self.pk is None:
+                self.save()
+            elif connection.vendor == "postgresql":
+                using, update_fields = self._state.db or DEFAULT_DB_ALIAS, frozenset({"config"})
+
+                pre_save.send(sender=Org, instance=self, raw=False, using=using, update_fields=update_fields)
+                Org.objects.using(using).filter(pk=self.pk).update(config=self._build_config_update(values))
+                post_save.send(
+                    sender=Org, instance=self, created=False, raw=False, using=using, update_fields=update_fields
+                )
+            else:
+                self.save(update_fields=("config",))
+
+    def _build_config_update(self, values):
+        """
+        Builds an expression which sets the given values in the config column with nested calls to jsonb_set
+        """
+        encoder = self._meta.get_field("config").encoder
+        sql, params = "COALESCE(config, '{}'::jsonb)", []
 
-        if key1 not in config:
-            config[key1] = dict()
+        # sections have to exist before we can set keys inside them
+        for key1 in sorted({key1 for key1, key2 in values}):
+            sql = f"jsonb_set({sql}, %s::text[], COALESCE(config -> %s, '{{}}'::jsonb))"
+            params += [[key1], key1]
 
-        config[key1][key2] = value
-        self.config = config
-        self._config = config
+        for path, value in values.items():
+            sql = f"jsonb_set({sql}, %s::text[], %s::jsonb)"
+            params += [list(path), json.dumps(value, cls=encoder)]
 
-        if commit:
-            self.save()
+        return RawSQL(sql, params, output_field=models.JSONField())
+
+    def _lookup_config(self, path, default):
+        """
+        Looks up a config value by its (section, key) path. This reads the config dict itself rather than a copy, so
+        changes made to it directly are always seen.
+        """
+        section = self.config.get(path[0]) if self.config else None
+        return section.get(path[1], default) if isinstance(section, dict) else default
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _get_config_path(name):
+        """
+        Parses a config name like 'rapidpro.reporter_group' into its (section, key) path, with names that have no
+        section being in 'common'
+        """
+        return tuple(name.split(".", 1)) if "." in name else ("common", name)
 
     def get_org_admins(self):
         return self.administrators.all()
@@ -145,17 +214,38 @@ class Org(SmartModel):
         if hasattr(user, "_org_group"):
             return user._org_group
 
-        if self.administrators.filter(id=user.id).exists():
-            user._org_group = Group.objects.get(name="Administrators")
-        elif self.editors.filter(id=user.id).exists():
-            user._org_group = Group.objects.get(name="Editors")
-        elif self.viewers.filter(id=user.id).exists():
-            user._org_group = Group.objects.get(name="Viewers")
-        else:
-            user._org_group = None
+        role = self.get_user_role(user)
+        group_name = {code: group for code, relation, group in ORG_ROLES}.get(role)
 
+        user._org_group = get_group(group_name) if group_name else None
         return user._org_group
 
+    def get_user_role(self, user):
+        """
+        Gets the role code of the given user in this org, or none if they're not a member. This is cached across requests
+        and looked up with a single query over the membership tables on a miss.
+        """
+        if user.id is None:
+            return None
+
+        key = USER_ROLE_CACHE_KEY % (self.id, user.id)
+        role = cache.get(key)
+
+        if role is None:
+            memberships = [
+                getattr(Org, relation)
+                .through.objects.filter(org_id=self.id, user_id=user.id)
+                .annotate(role=models.Value(code, output_field=models.CharField()))
+                .values_list("role", flat=True)
+                for code, relation, group in ORG_ROLES
+            ]
+            roles = set(memberships[0].union(*memberships[1:], all=True))
+
+            role = next((code for code, relation, group in ORG_ROLES if code in roles), "")
+            cache.set(key, role, USER_ROLE_CACHE_TIME)
+
+        return role or None
+
     def get_user(self):
         user = self.administrators.filter(is_active=True).first()
         if user:
@@ -198,6 +288,30 @@ class Org(SmartModel):
     def get_task_state(self, task_key):
         return TaskState.get_or_create(self, task_key)
 
+    @classmethod
+    def get_chooser_orgs(cls):
+        """
+        Gets the active orgs to list on the chooser page, as a cached payload of a version and a list of dicts of id,
+        name, logo URL and host link. The version changes whenever the payload is rebuilt so it can be used to key
+        cached fragments of the page.
+        """
+
+        def calculate():
+            orgs = []
+            for org in cls.objects.filter(is_active=True).order_by("name", "pk"):
+                orgs.append(
+                    {
+                        "id": org.id,
+                        "name": org.name,
+                        "logo_url": org.logo.url if org.logo else None,
+                        "host": org.build_host_link(),
+                    }
+                )
+
+            return {"version": uuid4().hex, "orgs": orgs}
+
+        return get_cacheable(CHOOSER_CACHE_KEY, CHOOSER_CACHE_TIME, calculate)
+
     @classmethod
     def create_user(cls, email, password):
         user = User.objects.create_user(username=email, email=email, password=password)
@@ -220,6 +334,117 @@ class Org(SmartModel):
 
     class Meta:
         ordering = ["name"]
+        indexes = [
+            # for case-insensitive lookups of orgs by host
+            models.Index(Lower("domain"), name="orgs_org_domain_lower_idx"),
+            models.Index(Lower("subdomain"), name="orgs_org_subdomain_lower_idx"),
+        ]
+
+
+def get_group(name):
+    """
+    Gets the auth group with the given name. Group ids are cached in this process so this doesn't require a query.
+    """
+    group_ids = _get_group_ids()
+    if name not in group_ids:
+        _get_group_ids.cache_clear()  # group may have been created since we cached
+        group_ids = _get_group_ids()
+
+        if name not in group_ids:
+            raise Group.DoesNotExist("No group named %s" % name)
+
+    return Group.from_db(DEFAULT_DB_ALIAS, ["id", "name"], [group_ids[name], name])
+
+
+@lru_cache(maxsize=1)
+def _get_group_ids():
+    return dict(Group.objects.values_list("name", "id"))
+
+
+@receiver(post_save, sender=Group, dispatch_uid="dash.orgs.models.group_saved")
+@receiver(post_delete, sender=Group, dispatch_uid="dash.orgs.models.group_deleted")
+def clear_group_ids(**kwargs):
+    _get_group_ids.cache_clear()
+
+
+# group id -> (frozenset of "app_label.codename" strings, expiry time)
+_group_perms = {}
+_group_perms_lock = threading.Lock()
+
+
+def get_group_perms(group):
+    """
+    Gets the permissions of the given group as a set of "app_label.codename" strings. These are cached in this process
+    until permissions change or for GROUP_PERMS_CACHE_TTL seconds.
+    """
+    with _group_perms_lock:
+        cached = _group_perms.get(group.id)
+
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    perms = group.permissions.values_list("content_type__app_label", "codename")
+    perms = frozenset("%s.%s" % (app_label, codename) for app_label, codename in perms)
+
+    with _group_perms_lock:
+        _group_perms[group.id] = (perms, time.monotonic() + GROUP_PERMS_CACHE_TTL)
+
+    return perms
+
+
+@receiver(post_save, sender=Org, dispatch_uid="dash.orgs.models.org_saved")
+@receiver(post_delete, sender=Org, dispatch_uid="dash.orgs.models.org_deleted")
+def clear_chooser_orgs(**kwargs):
+    # wait for the org change to commit, otherwise a concurrent request could cache the old list again
+    transaction.on_commit(partial(cache.delete, CHOOSER_CACHE_KEY))
+
+
+@receiver(setting_changed, dispatch_uid="dash.orgs.models.setting_changed")
+def clear_chooser_orgs_on_setting_changed(setting, **kwargs):
+    # these change how host links are built
+    if setting in ("HOSTNAME", "SESSION_COOKIE_SECURE"):
+        cache.delete(CHOOSER_CACHE_KEY)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through, dispatch_uid="dash.orgs.models.group_perms_changed")
+@receiver(post_save, sender=Permission, dispatch_uid="dash.orgs.models.permission_saved")
+@receiver(post_delete, sender=Permission, dispatch_uid="dash.orgs.models.permission_deleted")
+@receiver(post_delete, sender=Group, dispatch_uid="dash.orgs.models.group_perms_deleted")
+def clear_group_perms(**kwargs):
+    with _group_perms_lock:
+        _group_perms.clear()
+
+
+def clear_user_role_cache(org_ids, user_ids):
+    # wait for the membership change to commit, otherwise a concurrent request could cache the old role again
+    keys = [USER_ROLE_CACHE_KEY % (org_id, user_id) for org_id in org_ids for user_id in user_ids]
+    transaction.on_commit(partial(cache.delete_many, keys))
+
+
+@receiver(m2m_changed, sender=Org.administrators.through, dispatch_uid="dash.orgs.models.administrators_changed")
+@receiver(m2m_changed, sender=Org.editors.through, dispatch_uid="dash.orgs.models.editors_changed")
+@receiver(m2m_changed, sender=Org.viewers.through, dispatch_uid="dash.orgs.models.viewers_changed")
+def on_org_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidates cached user roles when users are added to or removed from an org relation, from either side, once the
+    change has been committed
+    """
+    if action in ("post_add", "post_remove"):
+        related_ids = pk_set
+    elif action == "pre_clear":
+        # once the relation is cleared we won't know who was in it
+        related_ids = set(
+            sender.objects.filter(**{"user_id" if reverse else "org_id": instance.pk}).values_list(
+                "org_id" if reverse else "user_id", flat=True
+            )
+        )
+    else:
+        return
+
+    if reverse:
+        clear_user_role_cache(related_ids, [instance.pk])
+    else:
+        clear_user_role_cache([instance.pk], related_ids)
 
 
 def get_org(obj):
@@ -342,6 +567,9 @@ class TaskState(models.Model):
 
     LOCK_KEY = "org-task-lock:%s:%s"
 
+    # the keys in task results which are counts of changes made, e.g. by syncing
+    CHANGE_KEYS = ("created", "updated", "deleted")
+
     org = models.ForeignKey(Org, on_delete=models.PROTECT, related_name="task_states")
 
     task_key = models.CharField(max_length=32)
@@ -367,6 +595,28 @@ class TaskState(models.Model):
 
         return cls.objects.create(org=org, task_key=task_key)
 
+    @classmethod
+    def upsert(cls, org, task_key, **values):
+        """
+        Creates or updates the state of the given task for the given org in a single statement, unless the task is
+        disabled for that org. Returns the updated state, or none if the task is disabled.
+        """
+        table = cls._meta.db_table
+        insert_values = {"is_failing": False, "is_disabled": False, **values}
+
+        def column(name):
+            return cls._meta.get_field(name).column
+
+        columns = ["org_id", "task_key"] + [column(name) for name in insert_values]
+        updates = [f"{column(name)} = EXCLUDED.{column(name)}" for name in values]
+
+        sql = (
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+            f"ON CONFLICT (org_id, task_key) DO UPDATE SET {', '.join(updates)} WHERE NOT {table}.is_disabled "
+            f"RETURNING *"
+        )
+        return next(iter(cls.objects.raw(sql, [org.id, task_key, *insert_values.values()])), None)
+
     @classmethod
     def get_lock_key(cls, org, task_key):
         return cls.LOCK_KEY % (org.id, task_key)
@@ -388,6 +638,24 @@ class TaskState(models.Model):
         until = self.ended_on if self.ended_on else timezone.now()
         return (until - self.started_on).total_seconds()
 
+    def get_num_changes(self, change_keys=CHANGE_KEYS):
+        """
+        Gets the total of the change counts in the last results, e.g. {"created": 3, "updated": 1, "ignored": 10} made
+        4 changes. Counts can be nested, e.g. {"contacts": {"created": 3}}, and other values such as sync metrics are
+        ignored. Returns none if the results don't contain any change counts.
+        """
+
+        def _counts(results):
+            for key, value in results.items():
+                if isinstance(value, dict):
+                    yield from _counts(value)
+                elif key in change_keys and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield value
+
+        results = self.get_last_results()
+        counts = list(_counts(results)) if isinstance(results, dict) else []
+        return sum(counts) if counts else None
+
     class Meta:
         constraints = [models.UniqueConstraint(fields=["org", "task_key"], name="orgs_taskstate_org_task_key_unique")]
 
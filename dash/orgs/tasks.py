@@ -1,21 +1,34 @@
 import inspect
 import json
 import logging
+import threading
+from datetime import timedelta
 from functools import wraps
 
-from celery import shared_task, signature
+from celery import current_app, group, shared_task, signature
 from django_valkey import get_valkey_connection
 from valkey.exceptions import LockError
 
 from django.apps import apps
 from django.utils import timezone
 
+from dash.utils import chunks
+from dash.utils.locks import LockHeartbeat
+
 from .models import Invitation, TaskState
 
 DEFAULT_LOCK_TIMEOUT = 60 * 60 * 2  # 2 hours
 
+TRIGGER_CHUNK_SIZE = 500
+
+ADAPTIVE_QUIET_INTERVAL = 60 * 60  # 1 hour
+ADAPTIVE_SLOW_THRESHOLD = 60 * 10  # 10 minutes
+
 logger = logging.getLogger(__name__)
 
+# the lock heartbeat of the org task running on this thread, if it has one
+_running = threading.local()
+
 
 @shared_task(track_started=True, name="send_invitation_email_task")
 def send_invitation_email_task(invitation_id):
@@ -27,64 +40,200 @@ def send_invitation_email_task(invitation_id):
 
 
 @shared_task
-def trigger_org_task(task_name, queue="celery"):
+def trigger_org_task(
+    task_name,
+    queue="celery",
+    chunk_size=TRIGGER_CHUNK_SIZE,
+    spread=0,
+    adaptive=False,
+    slow_queue=None,
+    quiet_interval=ADAPTIVE_QUIET_INTERVAL,
+    slow_threshold=ADAPTIVE_SLOW_THRESHOLD,
+):
     """
-    Triggers the given org task to be run for all active orgs
+    Triggers the given org task to be run for all active orgs. If it's an org task, orgs for which it is disabled or
+    still running are skipped rather than queuing sub-tasks which would do nothing.
     :param task_name: the full task name, e.g. 'myproj.myapp.tasks.do_stuff'
     :param queue: the name of the queue to send org sub-tasks to
+    :param chunk_size: the number of org sub-tasks to publish together as a group
+    :param spread: the number of seconds over which to stagger the org sub-tasks, or zero to run them all now
+    :param adaptive: whether to schedule orgs using the history of the org task (see get_adaptive_schedule)
+    :param slow_queue: the name of the queue to send sub-tasks for slow orgs to when adaptive
+    :param quiet_interval: the number of seconds to back off orgs for when their last run made no changes
+    :param slow_threshold: the number of seconds after which a run makes an org slow
     """
-    active_orgs = apps.get_model("orgs", "Org").objects.filter(is_active=True)
-    for org in active_orgs:
-        sig = signature(task_name, args=[org.pk])
-        sig.apply_async(queue=queue)
+    task = current_app.tasks.get(task_name)
+    task_key = getattr(task, "org_task_key", None)
+
+    active_orgs = apps.get_model("orgs", "Org").objects.filter(is_active=True).order_by("pk")
+    active_org_ids = active_orgs.values_list("pk", flat=True)
+    num_orgs = active_org_ids.count() if spread else None
+    num_sent, num_skipped = 0, 0
+
+    if task_key and adaptive:
+        change_keys = getattr(task, "org_task_change_keys", TaskState.CHANGE_KEYS)
+        schedule, skip_org_ids = get_adaptive_schedule(
+            task_key, active_org_ids, quiet_interval, slow_threshold, change_keys
+        )
+    else:
+        # orgs for which the task is disabled can be fetched once, but locks are checked per chunk as they're published
+        schedule = ((org_id, False) for org_id in active_org_ids.iterator(chunk_size=chunk_size))
+        skip_org_ids = set()
+        if task_key:
+            disabled_states = TaskState.objects.filter(org__is_active=True, task_key=task_key, is_disabled=True)
+            skip_org_ids.update(disabled_states.values_list("org_id", flat=True))
+
+    for scheduled in chunks(schedule, chunk_size):
+        locked_org_ids = get_locked_org_ids([org_id for org_id, _ in scheduled], task_key) if task_key else set()
+
+        sigs = []
+        for org_id, is_slow in scheduled:
+            if org_id in skip_org_ids or org_id in locked_org_ids:
+                num_skipped += 1
+                continue
+
+            options = {"queue": slow_queue if (is_slow and slow_queue) else queue}
+            if spread:
+                options["countdown"] = round(spread * (num_sent + num_skipped) / num_orgs, 3)
+
+            sigs.append(signature(task_name, args=[org_id], **options))
+            num_sent += 1
+
+        if sigs:
+            group(sigs).apply_async()
 
-    logger.info("Requested task '%s' for %d active orgs" % (task_name, len(active_orgs)))
+    logger.info(
+        "Requested task '%s' for %d active orgs (skipped %d as disabled, still running or quiet)"
+        % (task_name, num_sent, num_skipped)
+    )
 
 
-def org_task(task_key, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+def get_adaptive_schedule(task_key, org_ids, quiet_interval, slow_threshold, change_keys=TaskState.CHANGE_KEYS):
+    """
+    Schedules the given org task for the given orgs based on its history. Orgs which have never run it go first,
+    followed by those with the most changes in their last results, i.e. the total of the counts under change_keys.
+    Orgs whose last successful run made no changes are backed off until quiet_interval seconds have passed, and orgs
+    whose last run took at least slow_threshold seconds are flagged as slow.
+    :return: the list of (org_id, is_slow) tuples in order, and the set of org ids to skip
+    """
+    states = {s.org_id: s for s in TaskState.objects.filter(org__is_active=True, task_key=task_key)}
+    quiet_since = timezone.now() - timedelta(seconds=quiet_interval)
+
+    priorities, skip_org_ids = {}, set()
+    for org_id in org_ids:
+        state = states.get(org_id)
+
+        if not state or not state.has_ever_run():
+            priorities[org_id] = (float("inf"), False)
+            continue
+
+        num_changes = state.get_num_changes(change_keys)
+        is_slow = state.ended_on is not None and state.get_time_taken() >= slow_threshold
+
+        is_quiet = (
+            num_changes == 0
+            and not state.is_failing
+            and state.last_successfully_started_on is not None
+            and state.last_successfully_started_on > quiet_since
+        )
+        if state.is_disabled or is_quiet:
+            skip_org_ids.add(org_id)
+
+        priorities[org_id] = (num_changes or 0, is_slow)
+
+    ordered = sorted(priorities.items(), key=lambda p: p[1][0], reverse=True)  # stable so ties stay in org order
+    return [(org_id, is_slow) for org_id, (_, is_slow) in ordered], skip_org_ids
+
+
+def get_locked_org_ids(org_ids, task_key) -> set:
+    """
+    Gets which of the given orgs currently hold the lock for the given org task, in a single round trip to Valkey
+    """
+    pipe = get_valkey_connection().pipeline(transaction=False)
+    for org_id in org_ids:
+        pipe.exists(TaskState.LOCK_KEY % (org_id, task_key))
+
+    return {org_id for org_id, exists in zip(org_ids, pipe.execute()) if exists}
+
+
+def org_task(
+    task_key, lock_timeout=DEFAULT_LOCK_TIMEOUT, change_keys=TaskState.CHANGE_KEYS, heartbeat=False, coalesce=False
+):
     """
     Decorator to create an org task.
 
     The task holds a lock while it runs so that it can't run concurrently for the same org. The lock expires after
     lock_timeout seconds (2 hours by default) so that a dead worker can't hold it forever - which means a task that
-    runs longer than its lock timeout may be started concurrently. Set lock_timeout to comfortably exceed the task's
-    worst-case runtime.
+    runs longer than its lock timeout may be started concurrently. Either set lock_timeout to comfortably exceed the
+    task's worst-case runtime, or enable heartbeat so the lock is renewed for as long as the task runs, in which case
+    lock_timeout can be short and only bounds how long a dead worker holds the lock. If the heartbeat can't renew the
+    lock, is_org_task_lock_lost() starts returning true so that the task can stop early.
 
     :param task_key: the task key used for state storage and locking, e.g. 'do-stuff'
     :param lock_timeout: the lock timeout in seconds
+    :param change_keys: the keys in the task's results which count changes made, used when scheduling adaptively
+    :param heartbeat: whether to keep renewing the lock while the task runs
+    :param coalesce: whether to write the task state once when the task ends rather than also when it starts, which
+        suits frequent tasks that finish quickly but means a running task isn't visible as such
     """
 
     def _org_task(task_func):
         def _decorator(org_id):
             org = apps.get_model("orgs", "Org").objects.get(pk=org_id)
-            maybe_run_for_org(org, task_func, task_key, lock_timeout)
+            maybe_run_for_org(org, task_func, task_key, lock_timeout, heartbeat, coalesce)
 
-        return shared_task(wraps(task_func)(_decorator))
+        return shared_task(wraps(task_func)(_decorator), org_task_key=task_key, org_task_change_keys=tuple(change_keys))
 
     return _org_task
 
 
-def maybe_run_for_org(org, task_func, task_key, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+def is_org_task_lock_lost() -> bool:
+    """
+    Whether the org task running on this thread has a lock heartbeat which has failed to renew its lock, meaning the
+    task may now be started concurrently for the same org. Long-running tasks can check this to stop early.
+    """
+    lock_heartbeat = getattr(_running, "lock_heartbeat", None)
+    return lock_heartbeat is not None and lock_heartbeat.lost
+
+
+def maybe_run_for_org(org, task_func, task_key, lock_timeout=DEFAULT_LOCK_TIMEOUT, heartbeat=False, coalesce=False):
     """
     Runs the given task function for the specified org provided it's not already running
     :param org: the org
     :param task_func: the task function
     :param task_key: the task key
-    :param lock_timeout: the lock timeout in seconds (defaults to 1 hour so dead workers can't hold the lock forever)
+    :param lock_timeout: the lock timeout in seconds (defaults to 2 hours so dead workers can't hold the lock forever)
+    :param heartbeat: whether to keep renewing the lock while the task runs
+    :param coalesce: whether to write the task state once when the task ends rather than also when it starts
     """
     r = get_valkey_connection()
 
     key = TaskState.get_lock_key(org, task_key)
 
-    lock = r.lock(key, timeout=lock_timeout)
+    lock = r.lock(key, timeout=lock_timeout, thread_local=False)
 
     if not lock.acquire(blocking=False):
         logger.warning("Skipping task %s for org #%d as it is still running" % (task_key, org.id))
         return
 
+    lock_heartbeat = LockHeartbeat(lock).start() if heartbeat else None
+    prev_lock_heartbeat, _running.lock_heartbeat = getattr(_running, "lock_heartbeat", None), lock_heartbeat
+
     try:
-        state = org.get_task_state(task_key)
-        if state.is_disabled:
+        this_started_on = timezone.now()
+
+        # the start of the task is recorded in the same statement which creates or fetches its state, unless we're
+        # coalescing in which case we only read the state here and write it all when the task ends
+        if coalesce:
+            state = TaskState.objects.filter(org=org, task_key=task_key).first()
+            if state and state.is_disabled:
+                state = None
+            elif not state:
+                state = TaskState(org=org, task_key=task_key)
+        else:
+            state = TaskState.upsert(org, task_key, started_on=this_started_on, ended_on=None)
+
+        if not state:
             logger.info("Skipping task %s for org #%d as is marked disabled" % (task_key, org.id))
             return
 
@@ -92,11 +241,15 @@ def maybe_run_for_org(org, task_func, task_key, lock_timeout=DEFAULT_LOCK_TIMEOU
 
         prev_results = json.loads(state.last_results) if state.last_results else None
         prev_started_on = state.last_successfully_started_on
-        this_started_on = timezone.now()
 
         state.started_on = this_started_on
         state.ended_on = None
-        state.save(update_fields=("started_on", "ended_on"))
+
+        def save_state(*fields):
+            if coalesce:
+                TaskState.upsert(org, task_key, **{f: getattr(state, f) for f in ("started_on", *fields)})
+            else:
+                state.save(update_fields=fields)
 
         num_task_args = len(inspect.getfullargspec(task_func).args)
 
@@ -116,7 +269,7 @@ def maybe_run_for_org(org, task_func, task_key, lock_timeout=DEFAULT_LOCK_TIMEOU
             state.last_successfully_started_on = this_started_on
             state.last_results = json.dumps(results)
             state.is_failing = False
-            state.save(update_fields=("ended_on", "last_successfully_started_on", "last_results", "is_failing"))
+            save_state("ended_on", "last_successfully_started_on", "last_results", "is_failing")
 
             logger.info("Finished task %s for org #%d with result: %s" % (task_key, org.id, json.dumps(results)))
 
@@ -125,11 +278,22 @@ def maybe_run_for_org(org, task_func, task_key, lock_timeout=DEFAULT_LOCK_TIMEOU
             # successful results after a transient failure
             state.ended_on = timezone.now()
             state.is_failing = True
-            state.save(update_fields=("ended_on", "is_failing"))
+            save_state("ended_on", "is_failing")
 
             logger.exception("Task %s for org #%d failed" % (task_key, org.id))
             raise e  # re-raise with original stack trace
     finally:
+        _running.lock_heartbeat = prev_lock_heartbeat
+
+        if lock_heartbeat:
+            lock_heartbeat.stop()
+
+            if lock_heartbeat.lost:
+                logger.error(
+                    "Lock for task %s for org #%d was lost whilst it was running so it may have run concurrently"
+                    % (task_key, org.id)
+                )
+
         try:
             lock.release()
         except LockError:
@@ -22,7 +22,7 @@ from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 
 from .forms import CreateOrgLoginForm, OrgForm
-from .models import Invitation, Org, OrgBackend, OrgBackground, TaskState
+from .models import Invitation, Org, OrgBackend, OrgBackground, TaskState, get_group_perms
 
 
 class OrgPermsMixin(object):
@@ -62,7 +62,7 @@ class OrgPermsMixin(object):
         if self.org:
             org_group = self.get_user().get_org_group()
             if org_group:
-                if org_group.permissions.filter(content_type__app_label=app_label, codename=codename).exists():
+                if f"{app_label}.{codename}" in get_group_perms(org_group):
                     return True
 
         return False
@@ -145,13 +145,13 @@ class OrgCRUDL(SmartCRUDL):
         template_name = getattr(settings, "SITE_CHOOSER_TEMPLATE", "orgs/org_chooser.html")
 
         def get_context_data(self, **kwargs):
-            all_orgs = Org.objects.filter(is_active=True).order_by("name")
+            chooser = Org.get_chooser_orgs()
 
-            # populate a 'host' attribute on each org so we can link off to them
-            for org in all_orgs:
-                org.host = org.build_host_link()
-
-            return dict(orgs=all_orgs)
+            return dict(
+                orgs=chooser["orgs"],
+                chooser_version=chooser["version"],
+                chooser_cache_time=getattr(settings, "SITE_CHOOSER_FRAGMENT_CACHE_TIME", 0),
+            )
 
     class Create(SmartCreateView):
         form_class = OrgForm
@@ -301,13 +301,14 @@ class OrgCRUDL(SmartCRUDL):
             obj = super(OrgCRUDL.Edit, self).pre_save(obj)
             cleaned = self.form.cleaned_data
             is_super = self.request.user.is_superuser
+            config_values = dict()
 
             config_fields = getattr(settings, "ORG_CONFIG_FIELDS", [])
             for config_field in config_fields:
                 read_only = config_field.get("read_only", False)
                 if is_super or (not config_field.get("superuser_only", False) and not read_only):
                     name = "common.%s" % config_field["name"]
-                    obj.set_config(name, cleaned.get(name, None))
+                    config_values[name] = cleaned.get(name, None)
 
             backends = self.get_object().backends.filter(is_active=True)
             backends = backends.exclude(api_token="").exclude(api_token=None).values_list("slug", flat=True)
@@ -317,7 +318,10 @@ class OrgCRUDL(SmartCRUDL):
                     read_only = config_field.get("read_only", False)
                     if is_super or (not config_field.get("superuser_only", False) and not read_only):
                         name = "%s.%s" % (backend_slug, config_field["name"])
-                        obj.set_config(name, cleaned.get(name, None))
+                        config_values[name] = cleaned.get(name, None)
+
+            # the org itself is saved after this so there's no need to commit these separately
+            obj.set_configs(config_values, commit=False)
             return obj
 
         def derive_initial(self):
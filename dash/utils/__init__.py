@@ -1,4 +1,5 @@
 import calendar
+import hashlib
 import json
 import os
 import secrets
@@ -10,6 +11,7 @@ from uuid import uuid4
 from dateutil.relativedelta import relativedelta
 
 from django.core.cache import cache
+from django.db.models import Model
 from django.utils import timezone
 
 
@@ -169,6 +171,26 @@ def is_dict_equal(d1, d2, keys=None, ignore_none_values=True):
     return d1 == d2
 
 
+def dict_hash(d, keys=None, ignore_none_values=True):
+    """
+    Generates a compact hash of a dictionary such that dictionaries considered equal by is_dict_equal have the same hash.
+    Model instances are hashed by their primary key, and other values which aren't JSON serializable by their string
+    representation.
+    :param d: the dictionary
+    :param keys: the keys to limit the hash to (optional)
+    :param ignore_none_values: whether to ignore none values
+    :return: the hash as a 32 character hex string
+    """
+    if keys or ignore_none_values:
+        d = {k: v for k, v in d.items() if (keys is None or k in keys) and (v is not None or not ignore_none_values)}
+
+    def encode(value):
+        return value.pk if isinstance(value, Model) else str(value)
+
+    encoded = json.dumps(d, sort_keys=True, separators=(",", ":"), default=encode)
+    return hashlib.md5(encoded.encode("utf-8"), usedforsecurity=False).hexdigest()
+
+
 def generate_file_path(folder_name, instance, filename):
     name, extension = os.path.splitext(filename)
 
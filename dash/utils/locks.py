@@ -0,0 +1,146 @@
+import logging
+import threading
+import uuid
+
+from valkey.exceptions import LockError, LockNotOwnedError, ValkeyError
+
+"""
+Locking support
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class MultiLock:
+    """
+    Lock on multiple keys at once which acquires and releases all of them in single round trips to Valkey. If any of the
+    keys are held elsewhere, it falls back to waiting for each key in turn.
+    """
+
+    # KEYS - the lock keys
+    # ARGV[1] - token
+    # return the number of keys released
+    LUA_RELEASE_SCRIPT = """
+        local released = 0
+        for _, key in ipairs(KEYS) do
+            if redis.call('get', key) == ARGV[1] then
+                redis.call('del', key)
+                released = released + 1
+            end
+        end
+        return released
+    """
+
+    def __init__(self, client, keys, timeout, blocking_timeout=None, sleep=0.1):
+        """
+        :param client: the Valkey client
+        :param keys: the keys to lock
+        :param timeout: the expiry of each key in seconds
+        :param blocking_timeout: the maximum time in seconds to wait for each contended key, or none to wait forever
+        :param sleep: the time in seconds to sleep between attempts to acquire a contended key
+        """
+        self.client = client
+        self.keys = sorted(set(keys))
+        self.timeout = timeout
+        self.blocking_timeout = blocking_timeout
+        self.sleep = sleep
+        self.token = None
+        self.lua_release = client.register_script(self.LUA_RELEASE_SCRIPT)
+
+    def __enter__(self):
+        if self.acquire():
+            return self
+        raise LockError("Unable to acquire lock within the time specified")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self) -> bool:
+        """
+        Acquires all the keys, returning whether that was possible
+        """
+        token = uuid.uuid4().hex
+
+        pipe = self.client.pipeline(transaction=False)
+        for key in self.keys:
+            pipe.set(key, token, nx=True, px=int(self.timeout * 1000))
+
+        acquired = [key for key, was_set in zip(self.keys, pipe.execute()) if was_set]
+
+        if len(acquired) < len(self.keys):
+            # give back what we did get, then wait for each key in turn. Keys are sorted so a concurrent lock on some of
+            # the same keys which is also falling back can't deadlock with us.
+            self._release(acquired, token)
+
+            for k, key in enumerate(self.keys):
+                lock = self.client.lock(
+                    key, timeout=self.timeout, sleep=self.sleep, blocking_timeout=self.blocking_timeout
+                )
+                if not lock.acquire(token=token):
+                    self._release(self.keys[:k], token)
+                    return False
+
+        self.token = token
+        return True
+
+    def release(self):
+        """
+        Releases all the keys
+        """
+        if self.token is None:
+            raise LockError("Cannot release an unlocked lock")
+
+        token, self.token = self.token, None
+
+        if self._release(self.keys, token) < len(self.keys):
+            raise LockNotOwnedError("Cannot release a lock that's no longer owned")
+
+    def _release(self, keys, token) -> int:
+        return self.lua_release(keys=keys, args=[token]) if keys else 0
+
+
+class LockHeartbeat:
+    """
+    Keeps a held lock from expiring by resetting its expiry from a background thread, so that the lock timeout only has
+    to cover how long a dead worker may hold the lock for, rather than the longest time it will ever be legitimately
+    held. The lock must be created with thread_local=False so that the heartbeat thread can use its token.
+    """
+
+    def __init__(self, lock, interval=None):
+        """
+        :param lock: the Valkey lock, which should already be acquired
+        :param interval: the time in seconds between renewals, defaulting to a third of the lock timeout
+        """
+        self.lock = lock
+        self.interval = interval if interval is not None else lock.timeout / 3
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="lock-heartbeat:%s" % self.lock.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.lock.reacquire()
+            except LockError:
+                # the lock expired or was taken by someone else before we could renew it
+                self.lost = True
+                logger.warning("Lock %s was lost before it could be renewed" % self.lock.name)
+                return
+            except ValkeyError:
+                # a transient error talking to Valkey - try again at the next beat whilst the lock is still alive
+                logger.warning("Unable to renew lock %s" % self.lock.name, exc_info=True)
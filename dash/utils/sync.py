@@ -1,12 +1,27 @@
+import queue
+import threading
 import time
+import zlib
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
 from enum import Enum
 from typing import Optional, Tuple
+from uuid import uuid4
+
+from django.db import DatabaseError, connection, connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+from dash.utils import chunks, dict_hash
 
 """
 Sync support
 """
 
+BULK_DELETE_CHUNK_SIZE = 1000
+IDENTITY_TABLE_CHUNK_SIZE = 1000
+
 
 class SyncOutcome(Enum):
     created = 1
@@ -15,6 +30,103 @@ class SyncOutcome(Enum):
     ignored = 4
 
 
+class SyncMetrics(object):
+    """
+    Collects detailed metrics for a sync - the time spent in each phase and the number of database queries made. Times
+    are summed across worker threads so with workers they can exceed the elapsed time. Pass an instance to a sync
+    function and include as_dict() in the task results to have them stored in the task state.
+    """
+
+    PHASES = ("fetch", "lock", "fetch_local", "local_kwargs", "write")
+
+    def __init__(self):
+        self.times = {phase: 0.0 for phase in self.PHASES}
+        self.num_queries = 0
+        self.num_fetches = 0
+        self.started_on = time.perf_counter()
+        self._mutex = threading.Lock()
+
+    def add_time(self, phase, seconds: float):
+        with self._mutex:
+            self.times[phase] += seconds
+
+    @contextmanager
+    def timer(self, phase):
+        """
+        Times the wrapped block as part of the given phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    @contextmanager
+    def acquire(self, lock):
+        """
+        Holds the given lock for the wrapped block, timing how long it takes to acquire
+        """
+        with ExitStack() as stack:
+            with self.timer("lock"):
+                stack.enter_context(lock)
+            yield
+
+    def timed_fetches(self, fetches):
+        """
+        Iterates over fetches, timing how long is spent waiting for each
+        """
+        iterator, end = iter(fetches), object()
+        while True:
+            with self.timer("fetch"):
+                fetch = next(iterator, end)
+            if fetch is end:
+                return
+
+            with self._mutex:
+                self.num_fetches += 1
+            yield fetch
+
+    def count_queries(self):
+        """
+        Counts the queries made on the current thread's database connection in the wrapped block
+        """
+        return connection.execute_wrapper(self._count_query)
+
+    def _count_query(self, execute, sql, params, many, context):
+        with self._mutex:
+            self.num_queries += 1
+        return execute(sql, params, many, context)
+
+    def as_dict(self) -> dict:
+        return {
+            "elapsed": round(time.perf_counter() - self.started_on, 3),
+            "times": {phase: round(seconds, 3) for phase, seconds in self.times.items()},
+            "queries": self.num_queries,
+            "fetches": self.num_fetches,
+        }
+
+
+class _NoMetrics(object):
+    """
+    Stand-in for SyncMetrics when none are being collected
+    """
+
+    def timer(self, phase):
+        return nullcontext()
+
+    def acquire(self, lock):
+        return lock
+
+    def timed_fetches(self, fetches):
+        return fetches
+
+    def count_queries(self):
+        return nullcontext()
+
+
+_NO_METRICS = _NoMetrics()
+
+
 class BaseSyncer(object, metaclass=ABCMeta):
     """
     Base class for classes that describe how to synchronize particular local models against incoming data
@@ -26,6 +138,8 @@ class BaseSyncer(object, metaclass=ABCMeta):
     select_related = ()
     prefetch_related = ()
     local_backend_attr = None
+    bulk_writes = False  # whether to write batches and stale deletions with bulk queries rather than per instance
+    fingerprint_attr = None  # local field to store a hash of the local kwargs in, for change detection
 
     def __init__(self, backend):
         self.backend = backend
@@ -55,6 +169,27 @@ class BaseSyncer(object, metaclass=ABCMeta):
         """
         return self.model.lock(org, identity)
 
+    def lock_batch(self, org, identities):
+        """
+        Gets locks on all of the given identity values. If the model provides a lock_batch method, e.g. one that acquires
+        all the locks in a single round trip using MultiLock, that is used. Otherwise each lock is acquired in turn, in a
+        consistent order so that concurrent batches with overlapping identities can't deadlock.
+        :param org: the org
+        :param identities: the unique identities
+        :return: the lock
+        """
+        if hasattr(self.model, "lock_batch"):
+            return self.model.lock_batch(org, identities)
+
+        return self._lock_each(org, identities)
+
+    @contextmanager
+    def _lock_each(self, org, identities):
+        with ExitStack() as stack:
+            for identity in sorted(set(identities)):
+                stack.enter_context(self.lock(org, identity))
+            yield
+
     def fetch_local(self, org, identity):
         """
         Fetches the local model instance with the given identity, returning none if it doesn't exist
@@ -71,6 +206,27 @@ class BaseSyncer(object, metaclass=ABCMeta):
 
         return qs.first()
 
+    def fetch_local_batch(self, org, identities):
+        """
+        Fetches the local model instances with the given identities in a single query
+        :param org: the org
+        :param identities: the unique identities
+        :return: dict of identities to instances - identities which don't exist locally are omitted
+        """
+        qs = self.fetch_all(org=org).filter(**{self.local_id_attr + "__in": identities})
+
+        if self.select_related:
+            qs = qs.select_related(*self.select_related)
+        if self.prefetch_related:
+            qs = qs.prefetch_related(*self.prefetch_related)
+        if not qs.ordered:
+            qs = qs.order_by("pk")  # so duplicates resolve the same way as fetch_local
+
+        by_identity = {}
+        for local in qs:
+            by_identity.setdefault(self.identify_local(local), local)
+        return by_identity
+
     def fetch_all(self, org):
         """
         Fetches all local objects
@@ -96,14 +252,27 @@ class BaseSyncer(object, metaclass=ABCMeta):
     def update_required(self, local, remote, remote_as_kwargs):
         """
         Determines whether local instance differs from the remote object and so needs to be updated. By default this
-        will always update the local instance which is obviously inefficient.
+        compares fingerprints if the syncer has a fingerprint_attr, and otherwise will always update the local instance
+        which is obviously inefficient.
         :param local: the local instance
         :param remote: the incoming remote object
         :param remote_as_kwargs: the generated kwargs from remote object
         :return: whether the local instance must be updated
         """
+        if self.fingerprint_attr:
+            return getattr(local, self.fingerprint_attr) != remote_as_kwargs[self.fingerprint_attr]
+
         return True
 
+    def fingerprint(self, remote_as_kwargs):
+        """
+        Generates a compact hash of the generated kwargs from a remote object. As with is_dict_equal, none values are
+        ignored so adding a new nullable kwarg doesn't change the fingerprints of existing instances.
+        :param remote_as_kwargs: the generated kwargs from remote object
+        :return: the fingerprint
+        """
+        return dict_hash(remote_as_kwargs)
+
     def delete_local(self, local):
         """
         Deletes a local instance
@@ -134,45 +303,242 @@ class BaseSyncer(object, metaclass=ABCMeta):
         local.save()
         return local
 
+    def build_local(self, remote_as_kwargs):
+        """
+        Builds an unsaved local instance to be created by a bulk write
+        :param remote_as_kwargs: the generated kwargs from remote object
+        :return: the unsaved instance
+        """
+        return self.model(**remote_as_kwargs)
 
-def sync_from_remote(org, syncer, remote):
+    def apply_local(self, local, remote_as_kwargs):
+        """
+        Applies changes to a local instance to be saved by a bulk write. All kwargs must be concrete fields of the model.
+        :param local: the local instance
+        :param remote_as_kwargs: the generated kwargs from remote object
+        :return: the names of the fields which actually changed
+        """
+        changed = set()
+
+        for name, value in dict(remote_as_kwargs, is_active=True).items():
+            field = local._meta.get_field(name)
+
+            # compare foreign keys by id so that we don't fetch the related object just to compare it
+            if field.is_relation and name != field.attname:
+                current, new = getattr(local, field.attname), (value.pk if value is not None else None)
+            else:
+                current, new = getattr(local, name), value
+
+            if current != new:
+                changed.add(field.name)
+
+            setattr(local, name, value)
+
+        return changed
+
+    def create_locals(self, instances):
+        """
+        Creates local instances with a bulk write
+        :param instances: the unsaved instances
+        """
+        self.model.objects.bulk_create(instances)
+
+    def update_locals(self, instances, fields):
+        """
+        Updates local instances with a bulk write
+        :param instances: the changed instances
+        :param fields: the names of the fields to update
+        """
+        self.model.objects.bulk_update(instances, fields)
+
+    def delete_locals(self, org, pks):
+        """
+        Deletes local instances with a bulk write, skipping any which are no longer active
+        :param org: the org
+        :param pks: the primary keys of the instances
+        :return: the number of instances deleted
+        """
+        return self.fetch_all(org).filter(pk__in=pks, is_active=True).update(is_active=False)
+
+
+def sync_from_remote(org, syncer, remote, metrics: SyncMetrics = None):
     """
     Sync local instance against a single remote object
 
     :param * org: the org
     :param * syncer: the local model syncer
     :param * remote: the remote object
+    :param * metrics: the metrics to record timings in (optional)
     :return: the outcome (created, updated or deleted)
     """
+    metrics = metrics or _NO_METRICS
     identity = syncer.identify_remote(remote)
 
-    with syncer.lock(org, identity):
-        existing = syncer.fetch_local(org, identity)
+    with metrics.acquire(syncer.lock(org, identity)):
+        with metrics.timer("fetch_local"):
+            existing = syncer.fetch_local(org, identity)
+
+        outcome, local = _sync_existing(org, syncer, remote, existing, metrics=metrics)
+        return outcome
+
+
+def sync_batch_from_remote(org, syncer, remotes, metrics: SyncMetrics = None) -> dict:
+    """
+    Sync local instances against a batch of remote objects, e.g. a single fetch. Locks on all identities in the batch
+    are acquired up front and the existing local instances are loaded in a single query, rather than a query per
+    remote object.
+
+    :param * org: the org
+    :param * syncer: the local model syncer
+    :param * remotes: the list of remote objects
+    :param * metrics: the metrics to record timings in (optional)
+    :return: dict of counts of created, updated, deleted, ignored local instances
+    """
+    metrics = metrics or _NO_METRICS
+    outcome_counts = _new_outcome_counts()
+
+    identities = [syncer.identify_remote(remote) for remote in remotes]
+    if not identities:
+        return outcome_counts
+
+    writes = _BulkWrites(syncer, metrics) if syncer.bulk_writes else _ImmediateWrites(syncer, metrics)
+
+    with metrics.acquire(syncer.lock_batch(org, identities)):
+        with metrics.timer("fetch_local"):
+            existing_by_identity = syncer.fetch_local_batch(org, identities)
 
-        # derive kwargs for the local model (none return here means don't keep)
+        for remote, identity in zip(remotes, identities):
+            existing = existing_by_identity.get(identity)
+            outcome, local = _sync_existing(org, syncer, remote, existing, writes, metrics)
+            outcome_counts[outcome] += 1
+
+            # a remote object can appear more than once in a batch so later occurrences must see what earlier ones did
+            if local is not None:
+                existing_by_identity[identity] = local
+
+        writes.flush()  # must happen before we release the locks
+
+    return outcome_counts
+
+
+class _ImmediateWrites:
+    """
+    Writes local instance changes one at a time as they happen
+    """
+
+    def __init__(self, syncer, metrics=_NO_METRICS):
+        self.syncer = syncer
+        self.metrics = metrics
+
+    def create(self, remote_as_kwargs):
+        with self.metrics.timer("write"):
+            return self.syncer.create_local(remote_as_kwargs)
+
+    def update(self, local, remote_as_kwargs):
+        with self.metrics.timer("write"):
+            return self.syncer.update_local(local, remote_as_kwargs)
+
+    def delete(self, local):
+        with self.metrics.timer("write"):
+            self.syncer.delete_local(local)
+
+    def flush(self):
+        pass
+
+
+class _BulkWrites:
+    """
+    Collects local instance changes so they can be written with a single bulk create and a single bulk update, the
+    latter limited to the fields which actually changed
+    """
+
+    def __init__(self, syncer, metrics=_NO_METRICS):
+        self.syncer = syncer
+        self.metrics = metrics
+        self.created = {}
+        self.updated = {}
+        self.updated_fields = set()
+
+    def create(self, remote_as_kwargs):
+        local = self.syncer.build_local(remote_as_kwargs)
+        self.created[id(local)] = local
+        return local
+
+    def update(self, local, remote_as_kwargs):
+        changed = self.syncer.apply_local(local, remote_as_kwargs)
+        self._changed(local, changed)
+        return local
+
+    def delete(self, local):
+        local.is_active = False
+        self._changed(local, {"is_active"})
+
+    def _changed(self, local, fields):
+        # instances yet to be created will be inserted with their changes
+        if fields and id(local) not in self.created:
+            self.updated[id(local)] = local
+            self.updated_fields.update(fields)
+
+    def flush(self):
+        with self.metrics.timer("write"):
+            if self.created:
+                self.syncer.create_locals(list(self.created.values()))
+            if self.updated:
+                self.syncer.update_locals(list(self.updated.values()), sorted(self.updated_fields))
+
+        self.created, self.updated, self.updated_fields = {}, {}, set()
+
+
+def _sync_existing(org, syncer, remote, existing, writes=None, metrics=_NO_METRICS):
+    """
+    Syncs a possibly existing local instance against a remote object. Caller must hold the lock on its identity.
+
+    :return: tuple of the outcome and the local instance (if there is one)
+    """
+    writes = writes or _ImmediateWrites(syncer, metrics)
+
+    # derive kwargs for the local model (none return here means don't keep)
+    with metrics.timer("local_kwargs"):
         remote_as_kwargs = syncer.local_kwargs(org, remote)
 
-        # exists locally
-        if existing:
-            existing.org = org  # saves pre-fetching since we already have the org
+    if remote_as_kwargs and syncer.fingerprint_attr:
+        remote_as_kwargs = {**remote_as_kwargs, syncer.fingerprint_attr: syncer.fingerprint(remote_as_kwargs)}
 
-            if remote_as_kwargs:
-                if syncer.update_required(existing, remote, remote_as_kwargs) or not existing.is_active:
-                    syncer.update_local(existing, remote_as_kwargs)
-                    return SyncOutcome.updated
+    # exists locally
+    if existing:
+        existing.org = org  # saves pre-fetching since we already have the org
 
-            elif existing.is_active:  # exists locally, but shouldn't now to due to model changes
-                syncer.delete_local(existing)
-                return SyncOutcome.deleted
+        if remote_as_kwargs:
+            if syncer.update_required(existing, remote, remote_as_kwargs) or not existing.is_active:
+                return SyncOutcome.updated, writes.update(existing, remote_as_kwargs)
 
-        elif remote_as_kwargs:
-            syncer.create_local(remote_as_kwargs)
-            return SyncOutcome.created
+        elif existing.is_active:  # exists locally, but shouldn't now to due to model changes
+            writes.delete(existing)
+            return SyncOutcome.deleted, existing
 
-    return SyncOutcome.ignored
+    elif remote_as_kwargs:
+        return SyncOutcome.created, writes.create(remote_as_kwargs)
 
+    return SyncOutcome.ignored, existing
 
-def sync_local_to_set(org, syncer, remote_set) -> dict:
+
+def _new_outcome_counts() -> dict:
+    return {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0}
+
+
+def _add_outcome_counts(outcome_counts, other):
+    for outcome, count in other.items():
+        outcome_counts[outcome] += count
+
+
+def sync_local_to_set(
+    org,
+    syncer,
+    remote_set,
+    batch_size: int = None,
+    stream_identities: bool = False,
+    metrics: SyncMetrics = None,
+) -> dict:
     """
     Syncs an org's set of local instances of a model to match the set of remote objects. Local objects not in the remote
     set are deleted.
@@ -180,41 +546,156 @@ def sync_local_to_set(org, syncer, remote_set) -> dict:
     :param org: the org
     :param * syncer: the local model syncer
     :param remote_set: the set of remote objects
+    :param * batch_size: if provided, remote objects are synced in batches of this size (optional)
+    :param * stream_identities: whether to track remote identities in a temporary table rather than in memory, so that
+             memory use doesn't grow with the size of the remote set, which should then be an iterator (optional)
+    :param * metrics: the metrics to record timings and query counts in (optional)
     :return: dict of counts of created, updated, deleted, ignored local instances
     """
-    outcome_counts = {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0}
+    metrics = metrics or _NO_METRICS
+    outcome_counts = _new_outcome_counts()
+
+    with (
+        metrics.count_queries(),
+        _IdentityTable(syncer) if stream_identities else _IdentitySet() as remote_identities,
+    ):
+        if batch_size:
+            for batch in chunks(remote_set, batch_size):
+                _add_outcome_counts(outcome_counts, sync_batch_from_remote(org, syncer, batch, metrics))
+
+                remote_identities.add(syncer.identify_remote(remote) for remote in batch)
+        else:
+            for remote in remote_set:
+                outcome = sync_from_remote(org, syncer, remote, metrics)
+                outcome_counts[outcome] += 1
+
+                remote_identities.add([syncer.identify_remote(remote)])
+
+        # active local objects which weren't in the remote set need to be deleted
+        active_locals = syncer.fetch_all(org).filter(is_active=True)
+        delete_locals = remote_identities.exclude(active_locals, syncer.local_id_attr)
+
+        if syncer.bulk_writes:
+            # rather than locking each identity, rely on the row locks taken by each UPDATE - these serialize it
+            # against concurrent writes to the same rows and the is_active condition is re-checked against the latest
+            # version of each row, so rows deactivated or hard-deleted concurrently are counted as ignored
+            for pks in chunks(delete_locals.values_list("pk", flat=True).iterator(), BULK_DELETE_CHUNK_SIZE):
+                with metrics.timer("write"):
+                    num_deleted = syncer.delete_locals(org, pks)
+                outcome_counts[SyncOutcome.deleted] += num_deleted
+                outcome_counts[SyncOutcome.ignored] += len(pks) - num_deleted
+        else:
+            if stream_identities:
+                delete_locals = delete_locals.iterator()
+
+            for local in delete_locals:
+                identity = syncer.identify_local(local)
+
+                with metrics.acquire(syncer.lock(org, identity)):
+                    # re-check inside the lock that this object still exists and is active, as a concurrent sync may
+                    # have deactivated or hard-deleted it since the queryset was evaluated. Note this only sees
+                    # committed state under READ COMMITTED/autocommit - callers must not wrap syncs in an outer
+                    # transaction that outlives the lock.
+                    if syncer.fetch_all(org).filter(pk=local.pk, is_active=True).exists():
+                        with metrics.timer("write"):
+                            syncer.delete_local(local)
+                        outcome_counts[SyncOutcome.deleted] += 1
+                    else:
+                        outcome_counts[SyncOutcome.ignored] += 1
 
-    remote_identities = set()
+    return outcome_counts
 
-    for remote in remote_set:
-        outcome = sync_from_remote(org, syncer, remote)
-        outcome_counts[outcome] += 1
 
-        remote_identities.add(syncer.identify_remote(remote))
+class _IdentitySet:
+    """
+    Tracks remote identities in memory
+    """
 
-    # active local objects which weren't in the remote set need to be deleted
-    active_locals = syncer.fetch_all(org).filter(is_active=True)
-    delete_locals = active_locals.exclude(**{syncer.local_id_attr + "__in": remote_identities})
+    def __init__(self):
+        self.identities = set()
 
-    for local in delete_locals:
-        identity = syncer.identify_local(local)
+    def __enter__(self):
+        return self
 
-        with syncer.lock(org, identity):
-            # re-check inside the lock that this object still exists and is active, as a concurrent sync may have
-            # deactivated or hard-deleted it since the queryset was evaluated. Note this only sees committed state
-            # under READ COMMITTED/autocommit - callers must not wrap syncs in an outer transaction that outlives
-            # the lock.
-            if syncer.fetch_all(org).filter(pk=local.pk, is_active=True).exists():
-                syncer.delete_local(local)
-                outcome_counts[SyncOutcome.deleted] += 1
-            else:
-                outcome_counts[SyncOutcome.ignored] += 1
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
 
-    return outcome_counts
+    def add(self, identities):
+        self.identities.update(identities)
+
+    def exclude(self, queryset, local_id_attr):
+        return queryset.exclude(**{local_id_attr + "__in": self.identities})
+
+
+class _IdentityTable:
+    """
+    Tracks remote identities in a temporary database table, written in chunks, so that local instances not in the
+    remote set can be found with an anti-join in the database
+    """
+
+    def __init__(self, syncer):
+        self.id_field = syncer.model._meta.get_field(syncer.local_id_attr)
+        self.table = connection.ops.quote_name("sync_identities_%s" % uuid4().hex)
+        self.buffer = []
+
+    def __enter__(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE {self.table} (identity {self.id_field.db_type(connection)} NOT NULL)"
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {self.table}")
+        except DatabaseError:
+            # if we're already failing, e.g. the transaction is aborted, don't mask the original error - the table will
+            # be dropped with the session anyway
+            if exc_type is None:
+                raise
+
+    def add(self, identities):
+        self.buffer.extend(identities)
+
+        if len(self.buffer) >= IDENTITY_TABLE_CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            with connection.cursor() as cursor:
+                cursor.executemany(f"INSERT INTO {self.table} (identity) VALUES (%s)", [(i,) for i in self.buffer])
+            self.buffer = []
+
+    def exclude(self, queryset, local_id_attr):
+        self._flush()
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {self.table}")  # so the planner knows how big the table is
+
+        local_column = "%s.%s" % (
+            connection.ops.quote_name(queryset.model._meta.db_table),
+            connection.ops.quote_name(self.id_field.column),
+        )
+        not_in_table = RawSQL(
+            f"NOT EXISTS (SELECT 1 FROM {self.table} t WHERE t.identity = {local_column})",
+            (),
+            output_field=BooleanField(),
+        )
+        return queryset.filter(not_in_table)
 
 
 def sync_local_to_changes(
-    org, syncer, fetches, deleted_fetches, progress_callback=None, time_limit: int = None
+    org,
+    syncer,
+    fetches,
+    deleted_fetches,
+    progress_callback=None,
+    time_limit: int = None,
+    batch: bool = False,
+    prefetch: int = 0,
+    workers: int = 0,
+    metrics: SyncMetrics = None,
 ) -> Tuple[dict, Optional[str]]:
     """
     Sync local instances against iterators which return fetches of changed and deleted remote objects.
@@ -225,40 +706,215 @@ def sync_local_to_changes(
     :param * deleted_fetches: an iterator returning fetches of deleted remote objects
     :param * progress_callback: callable for tracking progress - called for each fetch with number of contacts fetched
     :param * time_limit: number of seconds to limit fetching too (optional)
+    :param * batch: whether to sync each fetch as a single batch rather than one remote object at a time (optional)
+    :param * prefetch: number of fetches to read ahead in a background thread whilst syncing the current one (optional)
+    :param * workers: number of threads to sync each fetch with, each taking a shard of its remote objects partitioned
+             by identity and using its own database connection (optional)
+    :param * metrics: the metrics to record timings and query counts in (optional)
     :return: tuple of a dict of counts of created, updated, deleted, ignored local instances and a possible cursor if
              fetching didn't complete
     """
+    metrics = metrics or _NO_METRICS
     num_synced = 0
-    outcome_counts = {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0}
+    outcome_counts = _new_outcome_counts()
     resume_cursor = None
 
     start = time.time()
 
-    for fetch in fetches:
-        for remote in fetch:
-            outcome = sync_from_remote(org, syncer, remote)
-            outcome_counts[outcome] += 1
+    with metrics.count_queries():
+        with (
+            _PrefetchingFetches(fetches, prefetch) if prefetch else nullcontext(fetches) as fetches,
+            _worker_pool(workers) if workers else nullcontext() as executor,
+        ):
+            for fetch in metrics.timed_fetches(fetches):
+                if executor:
+                    counts = _sync_sharded(org, syncer, fetch, batch, executor, workers, metrics)
+                else:
+                    counts = _sync_fetch(org, syncer, fetch, batch, metrics)
+
+                _add_outcome_counts(outcome_counts, counts)
+
+                num_synced += len(fetch)
+                if progress_callback:
+                    progress_callback(num_synced)
+
+                if time_limit and time.time() - start > time_limit:
+                    resume_cursor = fetches.get_cursor()
+                    break
+
+        # any item that has been deleted remotely should also be released locally
+        for deleted_fetch in metrics.timed_fetches(deleted_fetches):
+            if batch:
+                outcome_counts[SyncOutcome.deleted] += _delete_batch_from_remote(org, syncer, deleted_fetch, metrics)
+            else:
+                for deleted_remote in deleted_fetch:
+                    identity = syncer.identify_remote(deleted_remote)
+                    with metrics.acquire(syncer.lock(org, identity)):
+                        with metrics.timer("fetch_local"):
+                            existing = syncer.fetch_local(org, identity)
+                        if existing:
+                            with metrics.timer("write"):
+                                syncer.delete_local(existing)
+                            outcome_counts[SyncOutcome.deleted] += 1
+
+            num_synced += len(deleted_fetch)
+            if progress_callback:
+                progress_callback(num_synced)
 
-        num_synced += len(fetch)
-        if progress_callback:
-            progress_callback(num_synced)
+    return outcome_counts, resume_cursor
 
-        if time_limit and time.time() - start > time_limit:
-            resume_cursor = fetches.get_cursor()
-            break
 
-    # any item that has been deleted remotely should also be released locally
-    for deleted_fetch in deleted_fetches:
-        for deleted_remote in deleted_fetch:
-            identity = syncer.identify_remote(deleted_remote)
-            with syncer.lock(org, identity):
-                existing = syncer.fetch_local(org, identity)
-                if existing:
-                    syncer.delete_local(existing)
-                    outcome_counts[SyncOutcome.deleted] += 1
+def _sync_fetch(org, syncer, remotes, batch: bool, metrics=_NO_METRICS) -> dict:
+    """
+    Syncs a fetch of remote objects, either as a single batch or one remote object at a time
+    """
+    if batch:
+        return sync_batch_from_remote(org, syncer, remotes, metrics)
 
-        num_synced += len(deleted_fetch)
-        if progress_callback:
-            progress_callback(num_synced)
+    outcome_counts = _new_outcome_counts()
+    for remote in remotes:
+        outcome = sync_from_remote(org, syncer, remote, metrics)
+        outcome_counts[outcome] += 1
 
-    return outcome_counts, resume_cursor
+    return outcome_counts
+
+
+def _sync_sharded(org, syncer, remotes, batch: bool, executor, num_shards: int, metrics=_NO_METRICS) -> dict:
+    """
+    Syncs a fetch of remote objects by partitioning them by identity into shards which are synced concurrently. All
+    occurrences of an identity end up in the same shard so they're still synced in order.
+    """
+    shards = [[] for s in range(num_shards)]
+    for remote in remotes:
+        identity = str(syncer.identify_remote(remote))
+        shards[zlib.crc32(identity.encode("utf-8")) % num_shards].append(remote)
+
+    futures = [executor.submit(_sync_shard, org, syncer, shard, batch, metrics) for shard in shards if shard]
+
+    outcome_counts = _new_outcome_counts()
+    for future in futures:
+        _add_outcome_counts(outcome_counts, future.result())
+
+    return outcome_counts
+
+
+def _sync_shard(org, syncer, remotes, batch: bool, metrics) -> dict:
+    with metrics.count_queries():  # query counting has to be set up on this thread's own connection
+        return _sync_fetch(org, syncer, remotes, batch, metrics)
+
+
+@contextmanager
+def _worker_pool(num_workers: int):
+    """
+    Pool of threads to sync shards with. Each thread keeps its own database connection across shards and fetches, and
+    closes it when the pool shuts down.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        try:
+            yield executor
+        finally:
+            # the barrier holds each close task until all are running, so that every thread in the pool runs one
+            barrier = threading.Barrier(num_workers)
+            for future in [executor.submit(_close_worker_connections, barrier) for w in range(num_workers)]:
+                future.result()
+
+
+def _close_worker_connections(barrier):
+    barrier.wait()
+    connections.close_all()
+
+
+def _delete_batch_from_remote(org, syncer, deleted_remotes, metrics=_NO_METRICS) -> int:
+    """
+    Deletes the local instances of a batch of remotely deleted objects, returning the number deleted
+    """
+    identities = [syncer.identify_remote(remote) for remote in deleted_remotes]
+    if not identities:
+        return 0
+
+    num_deleted = 0
+    writes = _BulkWrites(syncer, metrics) if syncer.bulk_writes else _ImmediateWrites(syncer, metrics)
+
+    with metrics.acquire(syncer.lock_batch(org, identities)):
+        with metrics.timer("fetch_local"):
+            existing_by_identity = syncer.fetch_local_batch(org, identities)
+
+        for identity in identities:
+            existing = existing_by_identity.get(identity)
+            if existing:
+                writes.delete(existing)
+                num_deleted += 1
+
+        writes.flush()
+
+    return num_deleted
+
+
+class _PrefetchingFetches:
+    """
+    Wraps an iterator of fetches so that a background thread reads up to depth fetches ahead whilst the caller syncs
+    the current one. The cursor after each fetch is recorded as it's read, so get_cursor() returns the cursor to resume
+    from after the fetches handed to the caller, and not after those read ahead.
+    """
+
+    _END = object()
+
+    def __init__(self, fetches, depth: int):
+        self.fetches = fetches
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.finished = False
+        self.cursor = None
+
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        try:
+            for fetch in self.fetches:
+                cursor = self.fetches.get_cursor() if hasattr(self.fetches, "get_cursor") else None
+                if not self._put((fetch, cursor, None)):
+                    return
+
+            self._put(self._END)
+        except Exception as e:
+            self._put((None, None, e))
+
+    def _put(self, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # don't wait for the thread as it may be in the middle of a fetch - it will exit as soon as that completes
+        self.stopped.set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration()
+
+        item = self.queue.get()
+        if item is self._END:
+            self.finished = True
+            raise StopIteration()
+
+        fetch, cursor, error = item
+        if error:
+            self.finished = True
+            raise error
+
+        self.cursor = cursor
+        return fetch
+
+    def get_cursor(self):
+        return self.cursor
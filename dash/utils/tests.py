@@ -1,8 +1,12 @@
 import json
+import time
 import zoneinfo
 from datetime import datetime, timezone as tzone
 from itertools import chain
 
+from django_valkey import get_valkey_connection
+from valkey.exceptions import LockError, LockNotOwnedError
+
 from django.core.cache import cache
 
 from dash.test import DashTest
@@ -10,6 +14,7 @@ from dash.test import DashTest
 from . import (
     chunks,
     datetime_to_ms,
+    dict_hash,
     filter_dict,
     get_cacheable,
     get_month_range,
@@ -20,6 +25,7 @@ from . import (
     random_string,
     union,
 )
+from .locks import LockHeartbeat, MultiLock
 
 
 class InitTest(DashTest):
@@ -130,3 +136,111 @@ class InitTest(DashTest):
 
         self.assertTrue(is_dict_equal({"a": 1, "b": 2}, {"a": 1, "b": 2, "c": None}, ignore_none_values=True))
         self.assertFalse(is_dict_equal({"a": 1, "b": 2}, {"a": 1, "b": 2, "c": None}, ignore_none_values=False))
+
+    def test_dict_hash(self):
+        self.assertEqual(len(dict_hash({"a": 1})), 32)
+        self.assertEqual(dict_hash({"a": 1, "b": 2}), dict_hash({"b": 2, "a": 1}))
+        self.assertNotEqual(dict_hash({"a": 1, "b": 2}), dict_hash({"a": 1, "b": 3}))
+        self.assertNotEqual(dict_hash({"a": 1, "b": 2}), dict_hash({"a": 1, "c": 2}))
+        self.assertNotEqual(dict_hash({"a": 1}), dict_hash({"a": "1"}))
+
+        self.assertEqual(dict_hash({"a": 1, "b": 2, "c": 3}), dict_hash({"a": 1, "b": 2, "c": 4}, keys=("a", "b")))
+
+        # none values are ignored in the same way as is_dict_equal
+        self.assertEqual(dict_hash({"a": 1, "b": 2}), dict_hash({"a": 1, "b": 2, "c": None}))
+        self.assertNotEqual(
+            dict_hash({"a": 1, "b": 2}), dict_hash({"a": 1, "b": 2, "c": None}, ignore_none_values=False)
+        )
+
+        # model instances are hashed by their primary key and other values by their string representation
+        org = self.create_org("UNICEF", "Africa/Kampala", "unicef")
+        self.assertEqual(dict_hash({"org": org}), dict_hash({"org": org.pk}))
+        self.assertEqual(
+            dict_hash({"on": datetime(2014, 1, 2, tzinfo=tzone.utc)}), dict_hash({"on": "2014-01-02 00:00:00+00:00"})
+        )
+
+
+class MultiLockTest(DashTest):
+    def test_acquire_and_release(self):
+        r = get_valkey_connection()
+        lock = MultiLock(r, ["test-lock:2", "test-lock:1", "test-lock:2"], timeout=60)
+        self.assertEqual(lock.keys, ["test-lock:1", "test-lock:2"])
+
+        with lock:
+            self.assertEqual(r.get("test-lock:1"), lock.token.encode())
+            self.assertEqual(r.get("test-lock:2"), lock.token.encode())
+            self.assertTrue(0 < r.ttl("test-lock:1") <= 60)
+
+        self.assertFalse(r.exists("test-lock:1", "test-lock:2"))
+
+        # can't release a lock we don't hold
+        self.assertRaises(LockError, lock.release)
+
+        # or a lock which expired whilst we held it
+        self.assertTrue(lock.acquire())
+        r.delete("test-lock:2")
+        self.assertRaises(LockNotOwnedError, lock.release)
+        self.assertFalse(r.exists("test-lock:1"))
+
+    def test_contention(self):
+        r = get_valkey_connection()
+        other = r.lock("test-lock:2", timeout=60)
+        other.acquire()
+
+        # a contended key means the lock can't be acquired within the blocking timeout...
+        lock = MultiLock(r, ["test-lock:1", "test-lock:2", "test-lock:3"], timeout=60, blocking_timeout=0.2)
+        self.assertFalse(lock.acquire())
+        self.assertRaises(LockError, lock.__enter__)
+
+        # and any keys which were acquired are given back
+        self.assertFalse(r.exists("test-lock:1", "test-lock:3"))
+        self.assertTrue(other.owned())
+
+        # once the contended key is free, the lock falls back to acquiring each key in turn
+        other.release()
+        self.assertTrue(lock.acquire())
+        self.assertEqual(r.get("test-lock:2"), lock.token.encode())
+        lock.release()
+
+        # including when the contended key expires whilst we wait for it
+        other = r.lock("test-lock:3", timeout=0.5)
+        other.acquire()
+
+        with MultiLock(r, ["test-lock:1", "test-lock:3"], timeout=60, blocking_timeout=5) as lock:
+            self.assertEqual(r.get("test-lock:1"), lock.token.encode())
+            self.assertEqual(r.get("test-lock:3"), lock.token.encode())
+
+        self.assertFalse(r.exists("test-lock:1", "test-lock:3"))
+
+
+class LockHeartbeatTest(DashTest):
+    def test_renewal(self):
+        r = get_valkey_connection()
+        lock = r.lock("test-lock:1", timeout=1, thread_local=False)
+        lock.acquire()
+
+        # the lock outlives its timeout whilst the heartbeat is running...
+        with LockHeartbeat(lock, interval=0.2) as heartbeat:
+            time.sleep(1.5)
+            self.assertTrue(lock.owned())
+
+        self.assertFalse(heartbeat.lost)
+
+        # but not after it's stopped
+        time.sleep(1.5)
+        self.assertFalse(r.exists("test-lock:1"))
+
+    def test_lost(self):
+        r = get_valkey_connection()
+        lock = r.lock("test-lock:1", timeout=60, thread_local=False)
+        lock.acquire()
+
+        # a lock which is taken by someone else can't be renewed, and the heartbeat gives up
+        with LockHeartbeat(lock, interval=0.1) as heartbeat:
+            r.set("test-lock:1", "other")
+            time.sleep(0.3)
+
+        self.assertTrue(heartbeat.lost)
+        self.assertEqual(r.get("test-lock:1"), b"other")
+        self.assertEqual(heartbeat.interval, 0.1)
+        self.assertEqual(LockHeartbeat(lock).interval, 20)
@@ -0,0 +1,233 @@
+import json
+import platform
+import time
+import tracemalloc
+from importlib.metadata import PackageNotFoundError, version
+from uuid import uuid4
+
+from temba_client.v2.types import Contact as TembaContact
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from dash.orgs.models import Org
+from dash.utils import chunks
+from dash.utils.sync import SyncMetrics, sync_local_to_changes, sync_local_to_set
+
+from ...models import BulkContactSyncer, Contact, ContactSyncer
+
+SETUP_CHUNK_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the sync engine against synthetic sets of remote contacts"
+
+    SET = "set"
+    CHANGES = "changes"
+    MODE_CHOICES = (SET, CHANGES)
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[1000, 10000], help="The numbers of remote contacts to sync"
+        )
+        parser.add_argument(
+            "--modes", nargs="+", choices=self.MODE_CHOICES, default=list(self.MODE_CHOICES), help="The sync functions"
+        )
+        parser.add_argument("--creates", type=float, default=0.2, help="Fraction of remote contacts which are new")
+        parser.add_argument("--updates", type=float, default=0.2, help="Fraction of remote contacts which have changed")
+        parser.add_argument(
+            "--deletes", type=float, default=0.1, help="Number of local contacts to delete as a fraction of the size"
+        )
+        parser.add_argument("--fetch-size", type=int, default=250, help="The number of remote contacts per fetch")
+        parser.add_argument("--batch", action="store_true", help="Sync each fetch or chunk as a single batch")
+        parser.add_argument("--bulk-writes", action="store_true", help="Use a syncer with bulk writes")
+        parser.add_argument(
+            "--stream-identities", action="store_true", help="Track remote identities in a temporary table"
+        )
+        parser.add_argument("--prefetch", type=int, default=0, help="Number of fetches to read ahead")
+        parser.add_argument("--workers", type=int, default=0, help="Number of threads to sync each fetch with")
+        parser.add_argument("--no-memory", action="store_true", help="Don't trace memory, which slows syncing down")
+        parser.add_argument("--output", default=None, help="File to write the JSON results to instead of stdout")
+
+    def handle(self, *args, **options):
+        if options["creates"] + options["updates"] > 1:
+            raise CommandError("Fractions of new and changed contacts can't exceed 1")
+
+        run_id = uuid4().hex[:8]
+        user = User.objects.create_user(username="syncbench-%s" % run_id)
+        org = Org.objects.create(
+            name="Sync Benchmark %s" % run_id, subdomain="syncbench-%s" % run_id, created_by=user, modified_by=user
+        )
+        backend = org.backends.create(slug="rapidpro", api_token=run_id, created_by=user, modified_by=user)
+        syncer = (BulkContactSyncer if options["bulk_writes"] else ContactSyncer)(backend=backend)
+
+        results = []
+        try:
+            for size in options["sizes"]:
+                for mode in options["modes"]:
+                    scenario = Scenario(run_id, size, options["creates"], options["updates"], options["deletes"])
+                    scenario.setup(org, backend)
+
+                    results.append(self.run_scenario(org, syncer, mode, scenario, options))
+
+                    Contact.objects.filter(org=org).delete()
+        finally:
+            Contact.objects.filter(org=org).delete()
+            org.backends.all().delete()
+            org.delete()
+            user.delete()
+
+        output = json.dumps(
+            {
+                "version": get_version(),
+                "python": platform.python_version(),
+                "run_on": timezone.now().isoformat(),
+                "options": {
+                    key: options[key]
+                    for key in (
+                        "creates",
+                        "updates",
+                        "deletes",
+                        "fetch_size",
+                        "batch",
+                        "bulk_writes",
+                        "stream_identities",
+                        "prefetch",
+                        "workers",
+                    )
+                },
+                "results": results,
+            },
+            indent=2,
+        )
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run_scenario(self, org, syncer, mode, scenario, options) -> dict:
+        metrics = SyncMetrics()
+        trace_memory = not options["no_memory"]
+
+        if trace_memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        try:
+            if mode == self.SET:
+                outcome_counts = sync_local_to_set(
+                    org,
+                    syncer,
+                    scenario.remote_set(),
+                    batch_size=options["fetch_size"] if options["batch"] else None,
+                    stream_identities=options["stream_identities"],
+                    metrics=metrics,
+                )
+            else:
+                outcome_counts, cursor = sync_local_to_changes(
+                    org,
+                    syncer,
+                    SyntheticFetches(scenario.changed(), options["fetch_size"]),
+                    SyntheticFetches(scenario.deleted(), options["fetch_size"]),
+                    batch=options["batch"],
+                    prefetch=options["prefetch"],
+                    workers=options["workers"],
+                    metrics=metrics,
+                )
+
+            elapsed = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+
+        return {
+            "mode": mode,
+            "size": scenario.size,
+            "elapsed": round(elapsed, 3),
+            "per_second": round(scenario.size / elapsed, 1) if elapsed else None,
+            "queries": metrics.num_queries,
+            "peak_memory": peak_memory,
+            "outcomes": {outcome.name: count for outcome, count in outcome_counts.items()},
+            "metrics": metrics.as_dict(),
+        }
+
+
+class Scenario:
+    """
+    A synthetic set of local and remote contacts. Remote contacts are new, changed or unchanged, and there are local
+    contacts which aren't in the remote set and so are to be deleted.
+    """
+
+    def __init__(self, run_id, size: int, creates: float, updates: float, deletes: float):
+        self.run_id = run_id
+        self.size = size
+        self.num_creates = int(size * creates)
+        self.num_updates = int(size * updates)
+        self.num_unchanged = size - self.num_creates - self.num_updates
+        self.num_deletes = int(size * deletes)
+
+    def uuid(self, kind, num):
+        return "%s-%s-%09d" % (self.run_id, kind, num)
+
+    def setup(self, org, backend):
+        """
+        Creates the local contacts which will be updated, left unchanged or deleted by the sync
+        """
+
+        def existing():
+            for kind, count in (("u", self.num_updates), ("n", self.num_unchanged), ("d", self.num_deletes)):
+                for n in range(count):
+                    yield Contact(org=org, backend=backend, uuid=self.uuid(kind, n), name="Contact %d" % n)
+
+        for batch in chunks(existing(), SETUP_CHUNK_SIZE):
+            Contact.objects.bulk_create(batch)
+
+    def changed(self):
+        for n in range(self.num_creates):
+            yield TembaContact.create(uuid=self.uuid("c", n), name="Contact %d" % n, status="active")
+        for n in range(self.num_updates):
+            yield TembaContact.create(uuid=self.uuid("u", n), name="Changed %d" % n, status="active")
+
+    def unchanged(self):
+        for n in range(self.num_unchanged):
+            yield TembaContact.create(uuid=self.uuid("n", n), name="Contact %d" % n, status="active")
+
+    def deleted(self):
+        for n in range(self.num_deletes):
+            yield TembaContact.create(uuid=self.uuid("d", n))
+
+    def remote_set(self):
+        yield from self.changed()
+        yield from self.unchanged()
+
+
+class SyntheticFetches:
+    """
+    Iterator of fetches of remote objects, generated lazily like the fetches of a real API client
+    """
+
+    def __init__(self, remotes, fetch_size: int):
+        self.fetches = chunks(remotes, fetch_size)
+        self.num_fetched = 0
+
+    def get_cursor(self):
+        return "cursor-%d" % self.num_fetched
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        fetch = next(self.fetches)
+        self.num_fetched += 1
+        return fetch
+
+
+def get_version():
+    try:
+        return version("rapidpro-dash")
+    except PackageNotFoundError:
+        return None
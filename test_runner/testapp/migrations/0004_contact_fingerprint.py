@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("testapp", "0003_auto_20180405_1238"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="contact",
+            name="fingerprint",
+            field=models.CharField(max_length=32, null=True),
+        ),
+    ]
@@ -4,10 +4,13 @@ from django.db import models
 from django.utils.translation import gettext as _
 
 from dash.orgs.models import Org, OrgBackend
+from dash.utils.locks import MultiLock
 from dash.utils.sync import BaseSyncer
 
 
 class Contact(models.Model):
+    LOCK_KEY = "contact-lock:%d:%s"
+
     org = models.ForeignKey(Org, on_delete=models.PROTECT)
 
     uuid = models.CharField(max_length=36, unique=True)
@@ -18,9 +21,15 @@ class Contact(models.Model):
 
     backend = models.ForeignKey(OrgBackend, on_delete=models.PROTECT)
 
+    fingerprint = models.CharField(max_length=32, null=True)
+
     @classmethod
     def lock(cls, org, uuid):
-        return get_valkey_connection().lock("contact-lock:%d:%s" % (org.pk, uuid), timeout=60)
+        return get_valkey_connection().lock(cls.LOCK_KEY % (org.pk, uuid), timeout=60)
+
+    @classmethod
+    def lock_batch(cls, org, uuids):
+        return MultiLock(get_valkey_connection(), [cls.LOCK_KEY % (org.pk, uuid) for uuid in uuids], timeout=60)
 
 
 class ContactSyncer(BaseSyncer):
@@ -37,6 +46,22 @@ class ContactSyncer(BaseSyncer):
         return local.name != remote.name
 
 
+class BulkContactSyncer(ContactSyncer):
+    bulk_writes = True
+
+
+class FingerprintContactSyncer(BaseSyncer):
+    model = Contact
+    local_backend_attr = "backend"
+    fingerprint_attr = "fingerprint"
+
+    def local_kwargs(self, org, remote):
+        if remote.status == "blocked":  # we don't store blocked contacts
+            return None
+
+        return {"org": org, "uuid": remote.uuid, "name": remote.name, self.local_backend_attr: self.backend}
+
+
 class APIBackend(object):
     def __init__(self, backend):
         self.backend = backend
@@ -1,13 +1,34 @@
+import json
+import threading
 import time
 from contextlib import contextmanager
+from io import StringIO
+from unittest.mock import patch
 
+from django_valkey import get_valkey_connection
 from temba_client.v2.types import Contact as TembaContact
 
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from dash.orgs.models import Org
 from dash.test import DashTest, MockClientQuery
 from dash.utils import random_string
-from dash.utils.sync import SyncOutcome, sync_from_remote, sync_local_to_changes, sync_local_to_set
+from dash.utils.locks import MultiLock
+from dash.utils.sync import (
+    SyncMetrics,
+    SyncOutcome,
+    _close_worker_connections,
+    sync_batch_from_remote,
+    sync_from_remote,
+    sync_local_to_changes,
+    sync_local_to_set,
+)
 
-from .models import APIBackend, Contact, ContactSyncer
+from .models import APIBackend, BulkContactSyncer, Contact, ContactSyncer, FingerprintContactSyncer
 
 
 class SyncTest(DashTest):
@@ -45,10 +66,49 @@ class SyncTest(DashTest):
 
         self.assertIsInstance(self.unicef.get_backend(), APIBackend)
 
+    def test_lock_batch(self):
+        r = get_valkey_connection()
+
+        # contact model provides batch locking which acquires all the locks in a single round trip
+        lock = self.syncer.lock_batch(self.unicef, ["C-002", "C-001"])
+        self.assertIsInstance(lock, MultiLock)
+
+        with lock:
+            self.assertTrue(r.exists(f"contact-lock:{self.unicef.id}:C-001"))
+            self.assertTrue(r.exists(f"contact-lock:{self.unicef.id}:C-002"))
+
+            # and are the same locks as those taken for individual remote objects
+            self.assertFalse(r.lock(f"contact-lock:{self.unicef.id}:C-001", timeout=60).acquire(blocking=False))
+
+        self.assertFalse(r.exists(f"contact-lock:{self.unicef.id}:C-001"))
+
+        # models without batch locking fall back to acquiring each lock in turn, in a consistent order
+        locked = []
+
+        @contextmanager
+        def tracking_lock(org, identity):
+            locked.append(identity)
+            yield
+
+        model_lock_batch = Contact.__dict__["lock_batch"]
+        del Contact.lock_batch
+        self.syncer.lock = tracking_lock
+        try:
+            with self.syncer.lock_batch(self.unicef, ["C-002", "C-001", "C-002"]):
+                self.assertEqual(locked, ["C-001", "C-002"])
+        finally:
+            Contact.lock_batch = model_lock_batch
+            del self.syncer.lock
+
     def test_fetch_local(self):
         self.assertEqual(self.syncer.fetch_local(self.unicef, "C-001"), self.joe)
         self.assertEqual(self.syncer2.fetch_local(self.unicef, "CF-001"), self.joe2)
 
+    def test_fetch_local_batch(self):
+        self.assertEqual(self.syncer.fetch_local_batch(self.unicef, ["C-001", "CF-001", "C-999"]), {"C-001": self.joe})
+        self.assertEqual(self.syncer2.fetch_local_batch(self.unicef, ["C-001", "CF-001"]), {"CF-001": self.joe2})
+        self.assertEqual(self.syncer.fetch_local_batch(self.unicef, []), {})
+
     def test_local_kwargs(self):
         remote = TembaContact.create(uuid="C-002", name="Frank", status="active")
         kwargs = self.syncer.local_kwargs(self.unicef, remote)
@@ -102,6 +162,173 @@ class SyncTest(DashTest):
             org=self.unicef, uuid="C-002", name="Franky", backend=self.rapidpro_backend, is_active=False
         )
 
+    def test_sync_batch_from_remote(self):
+        remotes = [
+            TembaContact.create(uuid="C-001", name="Joseph", status="active"),  # changed name
+            TembaContact.create(uuid="C-002", name="Frank", status="active"),  # new contact
+            TembaContact.create(uuid="C-003", name="Colin", status="blocked"),  # doesn't belong locally
+        ]
+
+        # a single query fetches all existing contacts, then one query for each write
+        with self.assertNumQueries(3):
+            self.assertEqual(
+                {SyncOutcome.created: 1, SyncOutcome.updated: 1, SyncOutcome.deleted: 0, SyncOutcome.ignored: 1},
+                sync_batch_from_remote(self.unicef, self.syncer, remotes),
+            )
+
+        Contact.objects.get(org=self.unicef, uuid="C-001", name="Joseph", backend=self.rapidpro_backend, is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-002", name="Frank", backend=self.rapidpro_backend, is_active=True)
+        self.assertFalse(Contact.objects.filter(uuid="C-003").exists())
+
+        # later occurrences of the same identity in a batch see the effects of earlier ones
+        remotes = [
+            TembaContact.create(uuid="C-004", name="Donald", status="active"),  # new contact
+            TembaContact.create(uuid="C-004", name="Don", status="active"),  # then changed
+            TembaContact.create(uuid="C-002", name="Frank", status="blocked"),  # now blocked
+            TembaContact.create(uuid="C-002", name="Frank", status="blocked"),  # and already deleted
+        ]
+
+        self.assertEqual(
+            {SyncOutcome.created: 1, SyncOutcome.updated: 1, SyncOutcome.deleted: 1, SyncOutcome.ignored: 1},
+            sync_batch_from_remote(self.unicef, self.syncer, remotes),
+        )
+
+        Contact.objects.get(org=self.unicef, uuid="C-004", name="Don", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-002", name="Frank", is_active=False)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0},
+                sync_batch_from_remote(self.unicef, self.syncer, []),
+            )
+
+    def test_sync_batch_from_remote_bulk_writes(self):
+        syncer = BulkContactSyncer(backend=self.rapidpro_backend)
+
+        Contact.objects.create(org=self.unicef, uuid="C-002", name="Bob", backend=self.rapidpro_backend)
+        Contact.objects.create(org=self.unicef, uuid="C-003", name="Colin", backend=self.rapidpro_backend)
+        Contact.objects.create(
+            org=self.unicef, uuid="C-004", name="Donald", backend=self.rapidpro_backend, is_active=False
+        )
+
+        remotes = [
+            TembaContact.create(uuid="C-001", name="Joseph", status="active"),  # changed name
+            TembaContact.create(uuid="C-002", name="Bob", status="active"),  # no change
+            TembaContact.create(uuid="C-003", name="Colin", status="blocked"),  # now blocked
+            TembaContact.create(uuid="C-004", name="Donald", status="active"),  # reactivated
+            TembaContact.create(uuid="C-005", name="Edward", status="active"),  # new contact
+            TembaContact.create(uuid="C-006", name="Frank", status="active"),  # new contact
+            TembaContact.create(uuid="C-006", name="Frankie", status="active"),  # then changed
+        ]
+
+        # one query to fetch existing contacts, one bulk insert and one bulk update
+        with self.assertNumQueries(3):
+            self.assertEqual(
+                {SyncOutcome.created: 2, SyncOutcome.updated: 3, SyncOutcome.deleted: 1, SyncOutcome.ignored: 1},
+                sync_batch_from_remote(self.unicef, syncer, remotes),
+            )
+
+        Contact.objects.get(org=self.unicef, uuid="C-001", name="Joseph", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-002", name="Bob", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-003", name="Colin", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="C-004", name="Donald", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-005", name="Edward", backend=self.rapidpro_backend, is_active=True)
+        Contact.objects.get(
+            org=self.unicef, uuid="C-006", name="Frankie", backend=self.rapidpro_backend, is_active=True
+        )
+
+        # only fields which actually changed are written
+        contact = Contact(org=self.unicef, uuid="C-007", name="Gary", backend=self.rapidpro_backend)
+        self.assertEqual(syncer.apply_local(contact, {"org": self.unicef, "uuid": "C-007", "name": "Gerry"}), {"name"})
+        contact.is_active = False
+        self.assertEqual(syncer.apply_local(contact, {"backend": self.floip_backend}), {"backend", "is_active"})
+        self.assertEqual(contact.backend, self.floip_backend)
+
+        # nothing to write means no writes
+        with self.assertNumQueries(1):
+            sync_batch_from_remote(
+                self.unicef, syncer, [TembaContact.create(uuid="C-002", name="Bob", status="active")]
+            )
+
+        # bulk writes produce the same outcomes as writing one instance at a time
+        Contact.objects.all().delete()
+
+        fetches = MockClientQuery(
+            [
+                TembaContact.create(uuid="C-001", name="Anne", status="active"),
+                TembaContact.create(uuid="C-002", name="Bob", status="active"),
+                TembaContact.create(uuid="C-003", name="Colin", status="blocked"),
+            ]
+        )
+        deleted_fetches = MockClientQuery([TembaContact.create(uuid="C-001", name=None, status=None)])
+
+        self.assertEqual(
+            ({SyncOutcome.created: 2, SyncOutcome.updated: 0, SyncOutcome.deleted: 1, SyncOutcome.ignored: 1}, None),
+            sync_local_to_changes(self.unicef, syncer, fetches, deleted_fetches, batch=True),
+        )
+        Contact.objects.get(org=self.unicef, uuid="C-001", name="Anne", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="C-002", name="Bob", is_active=True)
+
+    def test_sync_from_remote_fingerprint(self):
+        syncer = FingerprintContactSyncer(backend=self.rapidpro_backend)
+
+        remote = TembaContact.create(uuid="C-002", name="Frank", status="active")
+        self.assertEqual(sync_from_remote(self.unicef, syncer, remote), SyncOutcome.created)
+
+        frank = Contact.objects.get(org=self.unicef, uuid="C-002", name="Frank", is_active=True)
+        self.assertEqual(frank.fingerprint, syncer.fingerprint(syncer.local_kwargs(self.unicef, remote)))
+
+        # fingerprint matches so no write is needed
+        with self.assertNumQueries(1):
+            self.assertEqual(sync_from_remote(self.unicef, syncer, remote), SyncOutcome.ignored)
+
+        # fingerprint ignores none values and compares related objects by id
+        self.assertEqual(
+            syncer.fingerprint(
+                {"org": self.unicef, "uuid": "C-002", "name": "Frank", "backend": self.rapidpro_backend}
+            ),
+            syncer.fingerprint(
+                {
+                    "org": self.unicef.id,
+                    "uuid": "C-002",
+                    "name": "Frank",
+                    "backend": self.rapidpro_backend.id,
+                    "x": None,
+                }
+            ),
+        )
+
+        # fingerprint changes
+        remote = TembaContact.create(uuid="C-002", name="Franky", status="active")
+        self.assertEqual(sync_from_remote(self.unicef, syncer, remote), SyncOutcome.updated)
+
+        frank.refresh_from_db()
+        self.assertEqual(frank.name, "Franky")
+        self.assertEqual(frank.fingerprint, syncer.fingerprint(syncer.local_kwargs(self.unicef, remote)))
+
+        # instances without a fingerprint, e.g. created before fingerprinting was enabled, are always updated
+        self.assertIsNone(self.joe.fingerprint)
+
+        remote = TembaContact.create(uuid="C-001", name="Joe", status="active")
+        self.assertEqual(sync_from_remote(self.unicef, syncer, remote), SyncOutcome.updated)
+        self.assertEqual(sync_from_remote(self.unicef, syncer, remote), SyncOutcome.ignored)
+
+        # fingerprints are written by bulk writes too
+        syncer.bulk_writes = True
+        remotes = [
+            TembaContact.create(uuid="C-001", name="Joseph", status="active"),
+            TembaContact.create(uuid="C-002", name="Franky", status="active"),
+        ]
+
+        self.assertEqual(
+            {SyncOutcome.created: 0, SyncOutcome.updated: 1, SyncOutcome.deleted: 0, SyncOutcome.ignored: 1},
+            sync_batch_from_remote(self.unicef, syncer, remotes),
+        )
+
+        self.joe.refresh_from_db()
+        self.assertEqual(self.joe.name, "Joseph")
+        self.assertEqual(self.joe.fingerprint, syncer.fingerprint(syncer.local_kwargs(self.unicef, remotes[0])))
+
     def test_sync_local_to_set(self):
         Contact.objects.all().delete()  # start with no contacts...
 
@@ -151,6 +378,144 @@ class SyncTest(DashTest):
         Contact.objects.get(org=self.unicef, uuid="CF-003", name="Colm", backend=self.floip_backend, is_active=True)
         Contact.objects.get(org=self.unicef, uuid="CF-005", name="Edward", backend=self.floip_backend, is_active=True)
 
+    def test_sync_local_to_set_batched(self):
+        Contact.objects.all().delete()  # start with no contacts...
+
+        remote_set = [
+            TembaContact.create(uuid="C-001", name="Anne", status="active"),
+            TembaContact.create(uuid="C-002", name="Bob", status="active"),
+            TembaContact.create(uuid="C-003", name="Colin", status="active"),
+            TembaContact.create(uuid="C-004", name="Donald", status="blocked"),
+        ]
+
+        self.assertEqual(
+            {SyncOutcome.created: 3, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 1},
+            sync_local_to_set(self.unicef, self.syncer, remote_set, batch_size=3),
+        )
+        self.assertEqual(Contact.objects.count(), 3)
+
+        remote_set = [
+            # first contact removed
+            TembaContact.create(uuid="C-002", name="Bob", status="active"),  # no change
+            TembaContact.create(uuid="C-003", name="Colm", status="active"),  # changed name
+            TembaContact.create(uuid="C-005", name="Edward", status="active"),  # new contact
+        ]
+
+        self.assertEqual(
+            {SyncOutcome.created: 1, SyncOutcome.updated: 1, SyncOutcome.deleted: 1, SyncOutcome.ignored: 1},
+            sync_local_to_set(self.unicef, self.syncer, iter(remote_set), batch_size=2),
+        )
+
+        self.assertEqual(Contact.objects.count(), 4)
+        Contact.objects.get(org=self.unicef, uuid="C-001", name="Anne", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="C-002", name="Bob", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-003", name="Colm", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-005", name="Edward", is_active=True)
+
+    @patch("dash.utils.sync.BULK_DELETE_CHUNK_SIZE", 2)
+    def test_sync_local_to_set_bulk_delete(self):
+        syncer = BulkContactSyncer(backend=self.rapidpro_backend)
+
+        Contact.objects.all().delete()  # start with no contacts...
+
+        for uuid in ("C-001", "C-002", "C-003", "C-004", "C-005"):
+            Contact.objects.create(org=self.unicef, uuid=uuid, name=uuid, backend=self.rapidpro_backend)
+
+        Contact.objects.create(org=self.unicef, uuid="CF-001", name="Anne", backend=self.floip_backend)
+
+        remote_set = [TembaContact.create(uuid="C-001", name="C-001", status="active")]
+
+        real_delete_locals = syncer.delete_locals
+
+        delete_calls = []
+
+        def racing_delete_locals(org, pks):
+            # simulate concurrent syncs changing objects after the deletion queryset was evaluated
+            if not delete_calls:
+                Contact.objects.filter(uuid="C-003").update(is_active=False)  # deactivated concurrently
+                Contact.objects.filter(uuid="C-004").delete()  # deleted concurrently
+
+            delete_calls.append(pks)
+            return real_delete_locals(org, pks)
+
+        syncer.delete_locals = racing_delete_locals
+
+        outcome_counts = sync_local_to_set(self.unicef, syncer, remote_set, batch_size=10)
+
+        # stale contacts are deleted in chunks rather than one at a time
+        self.assertEqual([2, 2], [len(pks) for pks in delete_calls])
+
+        # concurrently changed contacts count as ignored so the outcome buckets still sum to the number of candidates
+        self.assertEqual(
+            {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 2, SyncOutcome.ignored: 3},
+            outcome_counts,
+        )
+        Contact.objects.get(org=self.unicef, uuid="C-001", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-002", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="C-003", is_active=False)
+        self.assertFalse(Contact.objects.filter(uuid="C-004").exists())
+        Contact.objects.get(org=self.unicef, uuid="C-005", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="CF-001", is_active=True)  # other backend untouched
+
+    @patch("dash.utils.sync.IDENTITY_TABLE_CHUNK_SIZE", 2)
+    def test_sync_local_to_set_stream_identities(self):
+        Contact.objects.all().delete()  # start with no contacts...
+
+        def num_identity_tables():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM pg_tables WHERE tablename LIKE 'sync_identities_%'")
+                return cursor.fetchone()[0]
+
+        remote_set = [
+            TembaContact.create(uuid="C-001", name="Anne", status="active"),
+            TembaContact.create(uuid="C-002", name="Bob", status="active"),
+            TembaContact.create(uuid="C-003", name="Colin", status="active"),
+            TembaContact.create(uuid="C-004", name="Donald", status="blocked"),
+        ]
+
+        self.assertEqual(
+            {SyncOutcome.created: 3, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 1},
+            sync_local_to_set(self.unicef, self.syncer, iter(remote_set), stream_identities=True),
+        )
+        self.assertEqual(Contact.objects.count(), 3)
+
+        remote_set = [
+            # first contact removed
+            TembaContact.create(uuid="C-002", name="Bob", status="active"),  # no change
+            TembaContact.create(uuid="C-003", name="Colm", status="active"),  # changed name
+            TembaContact.create(uuid="C-005", name="Edward", status="active"),  # new contact
+        ]
+
+        self.assertEqual(
+            {SyncOutcome.created: 1, SyncOutcome.updated: 1, SyncOutcome.deleted: 1, SyncOutcome.ignored: 1},
+            sync_local_to_set(self.unicef, self.syncer, iter(remote_set), batch_size=2, stream_identities=True),
+        )
+
+        Contact.objects.get(org=self.unicef, uuid="C-001", name="Anne", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="C-002", name="Bob", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-003", name="Colm", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-005", name="Edward", is_active=True)
+
+        # also works with bulk deletion
+        remote_set = [TembaContact.create(uuid="C-005", name="Edward", status="active")]
+
+        self.assertEqual(
+            {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 2, SyncOutcome.ignored: 1},
+            sync_local_to_set(
+                self.unicef, BulkContactSyncer(self.rapidpro_backend), iter(remote_set), stream_identities=True
+            ),
+        )
+        self.assertEqual(set(Contact.objects.filter(is_active=True).values_list("uuid", flat=True)), {"C-005"})
+
+        # temporary tables are dropped afterwards, even if syncing fails
+        self.assertEqual(num_identity_tables(), 0)
+
+        with patch.object(self.syncer, "local_kwargs", side_effect=ValueError("boom")):
+            with self.assertRaises(ValueError):
+                sync_local_to_set(self.unicef, self.syncer, iter(remote_set), stream_identities=True)
+
+        self.assertEqual(num_identity_tables(), 0)
+
     def test_sync_local_to_set_recheck_under_lock(self):
         Contact.objects.all().delete()  # start with no contacts...
 
@@ -282,6 +647,50 @@ class SyncTest(DashTest):
             sync_local_to_changes(self.unicef, self.syncer2, fetches, deleted_fetches),
         )
 
+    def test_sync_local_to_changes_batched(self):
+        Contact.objects.all().delete()  # start with no contacts...
+
+        fetches = MockClientQuery(
+            [
+                TembaContact.create(uuid="C-001", name="Anne", status="active"),
+                TembaContact.create(uuid="C-002", name="Bob", status="active"),
+            ],
+            [
+                TembaContact.create(uuid="C-003", name="Colin", status="active"),
+                TembaContact.create(uuid="C-004", name="Donald", status="blocked"),
+            ],
+        )
+        deleted_fetches = MockClientQuery([])  # no deleted contacts this time
+
+        self.assertEqual(
+            ({SyncOutcome.created: 3, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 1}, None),
+            sync_local_to_changes(self.unicef, self.syncer, fetches, deleted_fetches, batch=True),
+        )
+
+        fetches = MockClientQuery(
+            [
+                TembaContact.create(uuid="C-002", name="Bob", status="blocked"),  # blocked so locally invalid
+                TembaContact.create(uuid="C-003", name="Colm", status="active"),  # changed name
+                TembaContact.create(uuid="C-005", name="Edward", status="active"),  # new contact
+            ]
+        )
+        deleted_fetches = MockClientQuery(
+            [
+                TembaContact.create(uuid="C-001", name=None, status=None),  # deleted
+                TembaContact.create(uuid="C-006", name=None, status=None),  # never existed locally
+            ]
+        )
+
+        self.assertEqual(
+            ({SyncOutcome.created: 1, SyncOutcome.updated: 1, SyncOutcome.deleted: 2, SyncOutcome.ignored: 0}, None),
+            sync_local_to_changes(self.unicef, self.syncer, fetches, deleted_fetches, batch=True),
+        )
+
+        Contact.objects.get(org=self.unicef, uuid="C-001", name="Anne", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="C-002", name="Bob", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="C-003", name="Colm", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-005", name="Edward", is_active=True)
+
     def test_sync_local_to_changes_partial(self):
         Contact.objects.all().delete()  # start with no contacts...
 
@@ -312,3 +721,235 @@ class SyncTest(DashTest):
             counts,
         )
         self.assertIsNotNone(cursor)
+
+    def test_sync_local_to_changes_prefetch(self):
+        Contact.objects.all().delete()  # start with no contacts...
+
+        class TrackingQuery(MockClientQuery):
+            """
+            Tracks how many fetches have been read and uses that as the cursor
+            """
+
+            num_read = 0
+
+            def get_cursor(self):
+                return "cursor-%d" % self.num_read
+
+            def __next__(self):
+                fetch = super().__next__()
+                self.num_read += 1
+                return fetch
+
+        fetches = TrackingQuery(
+            [
+                TembaContact.create(uuid="C-001", name="Anne", status="active"),
+                TembaContact.create(uuid="C-002", name="Bob", status="active"),
+            ],
+            [
+                TembaContact.create(uuid="C-003", name="Colin", status="active"),
+                TembaContact.create(uuid="C-004", name="Donald", status="blocked"),
+            ],
+            [TembaContact.create(uuid="C-005", name="Edward", status="active")],
+        )
+        deleted_fetches = MockClientQuery([TembaContact.create(uuid="C-001", name=None, status=None)])
+
+        self.assertEqual(
+            ({SyncOutcome.created: 4, SyncOutcome.updated: 0, SyncOutcome.deleted: 1, SyncOutcome.ignored: 1}, None),
+            sync_local_to_changes(self.unicef, self.syncer, fetches, deleted_fetches, prefetch=2),
+        )
+        self.assertEqual(Contact.objects.filter(is_active=True).count(), 3)
+
+        fetches = TrackingQuery(
+            [TembaContact.create(uuid="C-006", name="Frank", status="active")],
+            [TembaContact.create(uuid="C-007", name="Gary", status="active")],
+            [TembaContact.create(uuid="C-008", name="Harry", status="active")],
+        )
+
+        # make each fetch take at least a second by putting a delay in the progress function
+        def progress(num):
+            time.sleep(1)
+
+        counts, cursor = sync_local_to_changes(
+            self.unicef, self.syncer, fetches, MockClientQuery([]), progress, time_limit=1, batch=True, prefetch=2
+        )
+
+        # only had time for the first fetch, and even though more fetches were read ahead, the cursor resumes after the
+        # first fetch
+        self.assertEqual(
+            {SyncOutcome.created: 1, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0}, counts
+        )
+        self.assertEqual(cursor, "cursor-1")
+        self.assertGreater(fetches.num_read, 1)
+
+        # errors from fetching are raised in the syncing thread
+        class FailingQuery(TrackingQuery):
+            def __next__(self):
+                if self.num_read == 1:
+                    raise ValueError("API error")
+                return super().__next__()
+
+        fetches = FailingQuery(
+            [TembaContact.create(uuid="C-009", name="Ivan", status="active")],
+            [TembaContact.create(uuid="C-010", name="Jim", status="active")],
+        )
+
+        with self.assertRaises(ValueError):
+            sync_local_to_changes(self.unicef, self.syncer, fetches, MockClientQuery([]), prefetch=2)
+
+        Contact.objects.get(uuid="C-009")
+
+    def test_sync_metrics(self):
+        Contact.objects.all().delete()
+
+        fetches = MockClientQuery(
+            [
+                TembaContact.create(uuid="C-001", name="Anne", status="active"),
+                TembaContact.create(uuid="C-002", name="Bob", status="active"),
+            ],
+            [TembaContact.create(uuid="C-003", name="Colin", status="blocked")],
+        )
+        deleted_fetches = MockClientQuery([TembaContact.create(uuid="C-001", name=None, status=None)])
+
+        metrics = SyncMetrics()
+        with CaptureQueriesContext(connection) as captured:
+            sync_local_to_changes(self.unicef, self.syncer, fetches, deleted_fetches, batch=True, metrics=metrics)
+
+        self.assertEqual(metrics.num_queries, len(captured))
+        self.assertEqual(metrics.num_fetches, 3)
+
+        results = metrics.as_dict()
+        self.assertEqual(set(results.keys()), {"elapsed", "times", "queries", "fetches"})
+        self.assertEqual(set(results["times"].keys()), {"fetch", "lock", "fetch_local", "local_kwargs", "write"})
+        self.assertEqual(results["queries"], len(captured))
+        self.assertEqual(results["fetches"], 3)
+        self.assertEqual(json.loads(json.dumps(results)), results)  # can be stored in task results
+
+        # timings are recorded for the phase they happen in
+        metrics = SyncMetrics()
+
+        def slow_local_kwargs(org, remote):
+            time.sleep(0.1)
+            return ContactSyncer.local_kwargs(self.syncer, org, remote)
+
+        with patch.object(self.syncer, "local_kwargs", slow_local_kwargs):
+            sync_local_to_set(
+                self.unicef, self.syncer, [TembaContact.create(uuid="C-004", name="Dan")], metrics=metrics
+            )
+
+        self.assertGreaterEqual(metrics.times["local_kwargs"], 0.1)
+        self.assertLess(metrics.times["write"], 0.1)
+        self.assertGreater(metrics.num_queries, 0)
+        self.assertEqual(metrics.num_fetches, 0)
+
+
+class SyncWorkersTest(TransactionTestCase):
+    """
+    Syncing with worker threads needs real transactions as each worker uses its own database connection
+    """
+
+    def setUp(self):
+        DashTest.clear_cache()
+
+        self.superuser = User.objects.create_superuser(username="testroot", email="super@user.com", password="root")
+        self.unicef = Org.objects.create(
+            name="UNICEF",
+            timezone="Africa/Kampala",
+            subdomain="unicef",
+            created_by=self.superuser,
+            modified_by=self.superuser,
+        )
+        self.backend = self.unicef.backends.create(
+            api_token=random_string(32), slug="rapidpro", created_by=self.superuser, modified_by=self.superuser
+        )
+        self.syncer = ContactSyncer(backend=self.backend)
+
+    def test_sync_local_to_changes_with_workers(self):
+        Contact.objects.create(org=self.unicef, uuid="C-001", name="Anne", backend=self.backend)
+        Contact.objects.create(org=self.unicef, uuid="C-002", name="Bob", backend=self.backend)
+
+        fetches = MockClientQuery(
+            [TembaContact.create(uuid="C-%03d" % i, name="Contact %d" % i, status="active") for i in range(3, 23)]
+            + [
+                TembaContact.create(uuid="C-001", name="Annie", status="active"),  # changed name
+                TembaContact.create(uuid="C-002", name="Bob", status="blocked"),  # now blocked
+                TembaContact.create(uuid="C-003", name="Colin", status="active"),  # changed again in same fetch
+                TembaContact.create(uuid="C-099", name="Zed", status="blocked"),  # ignored
+            ],
+            [TembaContact.create(uuid="C-023", name="Contact 23", status="active")],
+        )
+        deleted_fetches = MockClientQuery([TembaContact.create(uuid="C-004", name=None, status=None)])
+
+        threads = set()
+        real_sync_from_remote = sync_from_remote
+
+        def tracking_sync_from_remote(org, syncer, remote, metrics=None):
+            threads.add(threading.get_ident())
+            return real_sync_from_remote(org, syncer, remote, metrics)
+
+        closing_threads = []
+        real_close_worker_connections = _close_worker_connections
+
+        def tracking_close_worker_connections(barrier):
+            closing_threads.append(threading.get_ident())
+            real_close_worker_connections(barrier)
+
+        with (
+            patch("dash.utils.sync.sync_from_remote", tracking_sync_from_remote),
+            patch("dash.utils.sync._close_worker_connections", tracking_close_worker_connections),
+        ):
+            self.assertEqual(
+                (
+                    {SyncOutcome.created: 21, SyncOutcome.updated: 2, SyncOutcome.deleted: 2, SyncOutcome.ignored: 1},
+                    None,
+                ),
+                sync_local_to_changes(self.unicef, self.syncer, fetches, deleted_fetches, workers=4),
+            )
+
+        self.assertGreater(len(threads), 1)
+        self.assertNotIn(threading.get_ident(), threads)
+
+        # worker connections are kept across fetches and closed once by each thread when the pool shuts down
+        self.assertEqual(len(closing_threads), 4)
+        self.assertEqual(len(set(closing_threads)), 4)
+        self.assertLessEqual(threads, set(closing_threads))
+
+        Contact.objects.get(uuid="C-001", name="Annie", is_active=True)
+        Contact.objects.get(uuid="C-002", is_active=False)
+        Contact.objects.get(uuid="C-003", name="Colin", is_active=True)
+        Contact.objects.get(uuid="C-004", is_active=False)
+        Contact.objects.get(uuid="C-023", is_active=True)
+        self.assertEqual(Contact.objects.filter(is_active=True).count(), 21)
+
+        # works with batches too
+        fetches = MockClientQuery(
+            [TembaContact.create(uuid="C-%03d" % i, name="Contact %d" % i, status="blocked") for i in range(5, 15)]
+        )
+
+        self.assertEqual(
+            ({SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 10, SyncOutcome.ignored: 0}, None),
+            sync_local_to_changes(self.unicef, self.syncer, fetches, MockClientQuery([]), batch=True, workers=3),
+        )
+        self.assertEqual(Contact.objects.filter(is_active=True).count(), 11)
+
+
+class SyncBenchTest(DashTest):
+    def test_command(self):
+        out = StringIO()
+        call_command("syncbench", "--sizes", "20", "--creates", "0.25", "--updates", "0.5", "--batch", stdout=out)
+
+        output = json.loads(out.getvalue())
+        self.assertEqual(output["options"]["batch"], True)
+        self.assertEqual([(r["mode"], r["size"]) for r in output["results"]], [("set", 20), ("changes", 20)])
+
+        # unchanged contacts are only included in the remote set
+        set_result, changes_result = output["results"]
+        self.assertEqual(set_result["outcomes"], {"created": 5, "updated": 10, "deleted": 2, "ignored": 5})
+        self.assertEqual(changes_result["outcomes"], {"created": 5, "updated": 10, "deleted": 2, "ignored": 0})
+
+        for result in output["results"]:
+            self.assertGreater(result["queries"], 0)
+            self.assertGreater(result["peak_memory"], 0)
+
+        # benchmark org and its contacts are cleaned up
+        self.assertFalse(Org.objects.filter(subdomain__startswith="syncbench-").exists())
+        self.assertFalse(Contact.objects.filter(uuid__contains="-c-").exists())
@@ -1,7 +1,12 @@
+import json
+import time
 import zoneinfo
-from unittest.mock import Mock, call, patch
+from datetime import timedelta
+from unittest.mock import AsyncMock, Mock, call, patch
 
 import valkey
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from celery import group as celery_group
 from django_valkey import get_valkey_connection
 from smartmin.tests import SmartminTest
 from temba_client.v2 import TembaClient
@@ -9,8 +14,10 @@ from temba_client.v2 import TembaClient
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, Group, Permission, User
 from django.core import mail
+from django.core.cache import cache
 from django.core.exceptions import DisallowedHost
 from django.db import connection
+from django.db.models.signals import post_save
 from django.db.utils import IntegrityError
 from django.http import HttpRequest, HttpResponse
 from django.test import override_settings
@@ -25,8 +32,17 @@ from dash.dashblocks.models import DashBlock, DashBlockImage, DashBlockType
 from dash.dashblocks.templatetags.dashblocks import load_qbs
 from dash.orgs.context_processors import GroupPermWrapper
 from dash.orgs.middleware import SetOrgMiddleware
-from dash.orgs.models import Invitation, Org, OrgBackend, OrgBackground, TaskState
-from dash.orgs.tasks import org_task
+from dash.orgs.models import (
+    Invitation,
+    Org,
+    OrgBackend,
+    OrgBackground,
+    TaskState,
+    clear_group_perms,
+    get_group,
+    get_group_perms,
+)
+from dash.orgs.tasks import is_org_task_lock_lost, org_task, trigger_org_task
 from dash.orgs.templatetags.dashorgs import display_time, national_phone
 from dash.orgs.views import OrgBackendForm, OrgCRUDL
 from dash.stories.models import Story, StoryImage
@@ -112,6 +128,12 @@ class DashTest(SmartminTest):
 
         self.admin = self.create_user("Administrator")
 
+        # cached state like user roles is keyed by ids which are reused across test runs
+        cache.clear()
+
+        # and cached group permissions don't see rollbacks of previous tests
+        clear_group_perms()
+
         # Clear DashBlockType from old migrations
         DashBlockType.objects.all().delete()
 
@@ -353,6 +375,106 @@ class SetOrgMiddlewareTest(DashTest):
         self.assertEqual(self.request.org, empty_subdomain_org)
         self.assertEqual(self.request.user.get_org(), empty_subdomain_org)
 
+    def test_host_cache(self):
+        ug_org = self.create_org("uganda", self.admin)
+
+        with self.assertNumQueries(1):
+            self.simulate_process("uganda.ureport.io", "dash.test_test")
+        self.assertEqual(self.request.org, ug_org)
+
+        # host resolution is now cached, leaving only the lookup of the org itself
+        with self.assertNumQueries(1):
+            self.simulate_process("UGANDA.ureport.io", "dash.test_test")
+        self.assertEqual(self.request.org, ug_org)
+
+        # as are hosts without an org
+        self.simulate_process("kenya.ureport.io", "dash.test_test")
+        with self.assertNumQueries(0):
+            response = self.simulate_process("kenya.ureport.io", "dash.test_test")
+        self.assertIsNone(self.request.org)
+        self.assertEqual(response.status_code, 302)
+
+        # saving an org clears the cache
+        ke_org = self.create_org("kenya", self.admin)
+        self.simulate_process("kenya.ureport.io", "dash.test_test")
+        self.assertEqual(self.request.org, ke_org)
+
+        ug_org.subdomain = "ug"
+        ug_org.save()
+
+        self.simulate_process("uganda.ureport.io", "dash.test_test")
+        self.assertIsNone(self.request.org)
+        self.simulate_process("ug.ureport.io", "dash.test_test")
+        self.assertEqual(self.request.org, ug_org)
+
+        # as does deleting one, but a cached org that no longer exists is resolved again anyway
+        self.simulate_process("kenya.ureport.io", "dash.test_test")
+        Org.objects.filter(pk=ke_org.pk).update(is_active=False)
+
+        with self.assertNumQueries(2):
+            self.simulate_process("kenya.ureport.io", "dash.test_test")
+        self.assertIsNone(self.request.org)
+
+        # cached resolutions expire
+        with patch("dash.orgs.middleware.time.monotonic", return_value=time.monotonic() + 61):
+            with self.assertNumQueries(1):
+                self.simulate_process("ug.ureport.io", "dash.test_test")
+
+        # and caching can be disabled
+        with self.settings(SITE_HOST_CACHE_TTL=0):
+            self.simulate_process("ug.ureport.io", "dash.test_test")
+            with self.assertNumQueries(1):
+                self.simulate_process("ug.ureport.io", "dash.test_test")
+            self.assertEqual(self.request.org, ug_org)
+
+    def test_resolve_org_priority(self):
+        ug_org = self.create_org("uganda", self.admin)
+        co_org = self.create_org("company", self.admin)
+        ug_org.domain = "UReport.co.ug"
+        ug_org.save()
+        co_org.domain = "co.ug"
+        co_org.save()
+
+        # a domain matching the last three parts of the host beats one matching the last two
+        with self.assertNumQueries(1):
+            self.simulate_process("www.ureport.CO.ug", "dash.test_test")
+        self.assertEqual(self.request.org, ug_org)
+
+        self.simulate_process("other.co.ug", "dash.test_test")
+        self.assertEqual(self.request.org, co_org)
+
+        # and any domain beats the subdomain
+        co_org.domain = "uganda.ureport.io"
+        co_org.save()
+
+        self.simulate_process("uganda.ureport.io", "dash.test_test")
+        self.assertEqual(self.request.org, co_org)
+
+    def test_host_parsing(self):
+        self.create_org("uganda", self.admin)
+
+        # the host is only parsed once per request
+        self.simulate_process("www.uganda.ureport.io", "dash.test_test")
+        self.assertEqual(self.request.get_host.call_count, 1)
+        self.assertEqual(self.middleware.get_host_parts(self.request), ["www", "uganda", "ureport", "io"])
+        self.assertEqual(self.middleware.get_subdomain(self.request), "uganda")
+        self.assertEqual(self.request.get_host.call_count, 1)
+
+        self.simulate_process("10.0.0.1", "dash.test_test")
+        self.assertEqual(self.middleware.get_host_parts(self.request), [])
+        self.assertEqual(self.middleware.get_subdomain(self.request), "")
+
+        # subdomains are only looked up for the configured hostname, and changes to it are picked up
+        self.simulate_process("uganda.ureport.ug", "dash.test_test")
+        self.assertEqual(self.middleware.get_subdomain(self.request), "")
+
+        with self.settings(HOSTNAME="ureport.ug"):
+            self.simulate_process("uganda.ureport.ug", "dash.test_test")
+            self.assertEqual(self.middleware.get_subdomain(self.request), "uganda")
+
+            self.simulate_process("ureport.ug", "dash.test_test")
+            self.assertEqual(self.middleware.get_subdomain(self.request), "")
+
     def simulate_call(self, host, url_name, path="/"):
         """
         Simulates a full middleware call, capturing the language and timezone active while the view runs
@@ -406,6 +528,94 @@ class SetOrgMiddlewareTest(DashTest):
         self.assertEqual(self.view_language, settings.LANGUAGE_CODE)
         self.assertEqual(self.view_timezone, settings.TIME_ZONE)
 
+    async def test_async_call(self):
+        self.addCleanup(translation.deactivate)
+        self.addCleanup(timezone.deactivate)
+
+        ug_org = await sync_to_async(self.create_org)("uganda", self.admin)
+        ug_org.language = "fr"
+        ug_org.timezone = zoneinfo.ZoneInfo("Africa/Kigali")
+        await ug_org.asave()
+
+        async def get_response(request):
+            self.view_language = translation.get_language()
+            self.view_timezone = timezone.get_current_timezone_name()
+            return HttpResponse()
+
+        middleware = SetOrgMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+
+        def create_request(host):
+            request = Mock(spec=HttpRequest)
+            request.get_host.return_value = host
+            request.auser = AsyncMock(return_value=self.admin)
+            return request
+
+        request = create_request("uganda.ureport.io")
+        response = await middleware(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.org, ug_org)
+        self.assertEqual(request.user, self.admin)
+        self.assertEqual(request.user.get_org(), ug_org)
+        self.assertEqual(self.view_language, "fr")
+        self.assertEqual(self.view_timezone, "Africa/Kigali")
+
+        # overrides are restored once the response is returned
+        self.assertEqual(translation.get_language(), settings.LANGUAGE_CODE)
+        self.assertEqual(timezone.get_current_timezone_name(), settings.TIME_ZONE)
+
+        # org-less requests work too, including when their resolution is cached
+        for i in range(2):
+            request = create_request("kenya.ureport.io")
+            request.auser = AsyncMock(return_value=AnonymousUser())
+            response = await middleware(request)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(request.org)
+            self.assertEqual(self.view_language, settings.LANGUAGE_CODE)
+
+        # a subclass which customises resolve_org resolves orgs the same way under ASGI
+        class FallbackMiddleware(SetOrgMiddleware):
+            def resolve_org(self, request):
+                return super().resolve_org(request) or Org.objects.get(subdomain="uganda")
+
+        middleware = FallbackMiddleware(get_response)
+
+        request = create_request("rwanda.ureport.io")
+        await middleware(request)
+
+        self.assertEqual(request.org, ug_org)
+        self.assertEqual(await middleware.aresolve_org(create_request("uganda.ureport.io")), ug_org)
+
+        # as does one which customises get_org
+        class PinnedMiddleware(SetOrgMiddleware):
+            def get_org(self, request):
+                return Org.objects.get(subdomain="uganda")
+
+        middleware = PinnedMiddleware(get_response)
+
+        request = create_request("kenya.ureport.io")
+        await middleware(request)
+
+        self.assertEqual(request.org, ug_org)
+
+        # and one which customises process_request isn't bypassed
+        class TaggingMiddleware(SetOrgMiddleware):
+            def process_request(self, request):
+                request.tagged = True
+                return super().process_request(request)
+
+        middleware = TaggingMiddleware(get_response)
+
+        request = create_request("uganda.ureport.io")
+        request.user = self.admin
+        await middleware(request)
+
+        self.assertTrue(request.tagged)
+        self.assertEqual(request.org, ug_org)
+        self.assertEqual(request.user.get_org(), ug_org)
+
     def test_org_less_request_keeps_negotiated_language(self):
         self.addCleanup(translation.deactivate)
         self.addCleanup(timezone.deactivate)
@@ -453,6 +663,48 @@ class OrgContextProcessorTestcase(DashTest):
         self.assertFalse(viewers_wrapper["orgs"]["org_edit"])
         self.assertFalse(viewers_wrapper["orgs"]["org_home"])
 
+        self.assertIn("orgs", administrators_wrapper)
+        self.assertIn("orgs.org_edit", administrators_wrapper)
+        self.assertNotIn("orgs.org_edit", editors_wrapper)
+        self.assertNotIn("xyz", editors_wrapper)
+        self.assertRaises(TypeError, iter, editors_wrapper)
+
+        # permissions aren't loaded until they're looked up, and then come from the shared cache
+        clear_group_perms()
+
+        with self.assertNumQueries(0):
+            wrapper = GroupPermWrapper(editors)
+        with self.assertNumQueries(1):
+            self.assertTrue(wrapper["orgs"]["org_home"])
+        with self.assertNumQueries(0):
+            self.assertIn("stories.story_create", wrapper)
+            self.assertIn("stories.story_create", GroupPermWrapper(editors))
+
+    def test_group_perms(self):
+        editors = Group.objects.get(name="Editors")
+
+        with self.assertNumQueries(1):
+            perms = get_group_perms(editors)
+        self.assertIn("orgs.org_home", perms)
+        self.assertIn("stories.story_create", perms)
+        self.assertNotIn("orgs.org_edit", perms)
+
+        # permissions are cached
+        with self.assertNumQueries(0):
+            self.assertEqual(get_group_perms(editors), perms)
+
+        # until they change
+        editors.permissions.add(Permission.objects.get(content_type__app_label="orgs", codename="org_edit"))
+        self.assertIn("orgs.org_edit", get_group_perms(editors))
+
+        editors.permissions.remove(Permission.objects.get(content_type__app_label="orgs", codename="org_edit"))
+        self.assertNotIn("orgs.org_edit", get_group_perms(editors))
+
+        # or expire
+        with patch("dash.orgs.models.time.monotonic", return_value=time.monotonic() + 301):
+            with self.assertNumQueries(1):
+                get_group_perms(editors)
+
 
 class OrgBackendTest(DashTest):
     def setUp(self):
@@ -642,20 +894,23 @@ class OrgTest(DashTest):
 
         self.assertIsNone(self.org.get_user_org_group(AnonymousUser()))
 
+        get_group("Viewers")  # ensure group ids are cached in this process
+
         def assert_membership_queries(user, group_name):
             with CaptureQueriesContext(connection) as context:
                 group = self.org.get_user_org_group(user)
 
             self.assertEqual(group_name, group.name if group else None)
+            if group:
+                self.assertEqual(group, Group.objects.get(name=group_name))
 
-            # ignore the query that fetches the group itself
-            membership_queries = [q["sql"] for q in context.captured_queries if '"auth_group"' not in q["sql"]]
-            self.assertTrue(membership_queries)
-
-            # membership is checked with existence queries rather than fetching entire member lists
-            for sql in membership_queries:
-                self.assertTrue(sql.startswith("SELECT 1 AS"), f"expected an existence query but got: {sql}")
-                self.assertNotIn('"auth_user"."password"', sql)
+            # membership is checked with a single query over the membership tables rather than fetching entire member
+            # lists, and the group itself doesn't need fetching
+            self.assertEqual(len(context.captured_queries), 1)
+            sql = context.captured_queries[0]["sql"]
+            self.assertIn("UNION ALL", sql)
+            self.assertNotIn('"auth_user"', sql)
+            self.assertNotIn('"auth_group"', sql)
 
         assert_membership_queries(self.admin, "Administrators")
         assert_membership_queries(editor, "Editors")
@@ -668,6 +923,59 @@ class OrgTest(DashTest):
         with self.assertNumQueries(0):
             self.assertIsNone(self.org.get_user_org_group(non_member))
 
+        # and across requests, i.e. for new instances of the same user
+        editor, non_member = User.objects.get(pk=editor.pk), User.objects.get(pk=non_member.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.org.get_user_org_group(editor).name, "Editors")
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.org.get_user_org_group(non_member))
+
+    def test_get_user_role_invalidation(self):
+        user = self.create_user("User")
+        other_org = self.create_org("kenya", self.admin)
+
+        def get_role(org):
+            return Org.objects.get(pk=org.pk).get_user_role(User.objects.get(pk=user.pk))
+
+        self.assertIsNone(get_role(self.org))
+
+        # cached roles are only invalidated once the change is committed
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.org.viewers.add(user)
+            self.assertIsNone(get_role(self.org))
+
+        self.assertEqual(len(callbacks), 1)
+        callbacks[0]()
+        self.assertEqual(get_role(self.org), "V")
+
+        # admin takes precedence over other roles
+        with self.captureOnCommitCallbacks(execute=True):
+            self.org.administrators.add(user)
+        self.assertEqual(get_role(self.org), "A")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.org.administrators.remove(user)
+        self.assertEqual(get_role(self.org), "V")
+
+        # changes from the user side of the relation
+        with self.captureOnCommitCallbacks(execute=True):
+            user.org_editors.add(self.org, other_org)
+        self.assertEqual(get_role(self.org), "E")
+        self.assertEqual(get_role(other_org), "E")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user.org_editors.clear()
+        self.assertEqual(get_role(self.org), "V")
+        self.assertIsNone(get_role(other_org))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.org.viewers.clear()
+        self.assertIsNone(get_role(self.org))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.org.viewers.set([user])
+        self.assertEqual(get_role(self.org), "V")
+
     def test_org_model(self):
         user = self.create_user("User")
 
@@ -755,6 +1063,35 @@ class OrgTest(DashTest):
         self.assertEqual(self.org.get_config("field_name"), "field_value")
         self.assertEqual(self.org.get_config("other_field_name"), "other_value")
 
+    def test_get_configs(self):
+        self.org.set_config("shortcode", "224433", commit=False)
+        self.org.set_config("rapidpro.reporter_group", "reporters", commit=False)
+        self.org.set_config("rapidpro.flows.registration", "abc", commit=False)
+
+        self.assertEqual(self.org.get_config("common.shortcode"), "224433")
+        self.assertEqual(self.org.get_config("rapidpro.flows.registration"), "abc")
+        self.assertEqual(
+            self.org.get_configs(["shortcode", "rapidpro.reporter_group", "rapidpro.other"], default=""),
+            {"shortcode": "224433", "rapidpro.reporter_group": "reporters", "rapidpro.other": ""},
+        )
+
+        # replacing the config, e.g. by refreshing from the database, is picked up
+        self.org.config = {"common": {"shortcode": "1234"}, "invalid": 5}
+        self.assertEqual(self.org.get_config("shortcode"), "1234")
+        self.assertIsNone(self.org.get_config("rapidpro.reporter_group"))
+
+        self.org.refresh_from_db()
+        self.assertIsNone(self.org.get_config("shortcode"))
+
+        # as are changes made directly to the config dict
+        self.org.config["common"] = {"shortcode": "5678"}
+        self.org.config["rapidpro"] = {"reporter_group": "reporters"}
+        self.assertEqual(self.org.get_config("shortcode"), "5678")
+        self.assertEqual(self.org.get_configs(["rapidpro.reporter_group"]), {"rapidpro.reporter_group": "reporters"})
+
+        self.org.config["common"]["shortcode"] = "9012"
+        self.assertEqual(self.org.get_config("shortcode"), "9012")
+
     def test_set_config_commit(self):
         """By default, Org.set_config should commit change to database."""
         self.org.set_config("test", "hello")
@@ -762,6 +1099,60 @@ class OrgTest(DashTest):
         org = Org.objects.get(pk=self.org.pk)  # refresh from db
         self.assertEqual(org.get_config("test"), "hello")
 
+    def test_set_configs(self):
+        self.org.set_config("shortcode", "224433")
+        self.org.name = "Changed"
+
+        receiver = Mock()
+        post_save.connect(receiver, sender=Org)
+        self.addCleanup(post_save.disconnect, receiver, sender=Org)
+
+        # only the given keys of the config are written, in a single query
+        with self.assertNumQueries(1):
+            self.org.set_configs({"rapidpro.reporter_group": "reporters", "rapidpro.is_on": True, "lang": ["en", "fr"]})
+
+        # but receivers still hear about it as they would for a save of just the config
+        receiver.assert_called_once()
+        self.assertEqual(receiver.call_args.kwargs["instance"], self.org)
+        self.assertFalse(receiver.call_args.kwargs["created"])
+        self.assertEqual(receiver.call_args.kwargs["update_fields"], {"config"})
+
+        self.assertEqual(self.org.get_config("rapidpro.reporter_group"), "reporters")
+
+        org = Org.objects.get(pk=self.org.pk)
+        self.assertEqual(org.name, "uganda")
+        self.assertEqual(
+            org.config,
+            {
+                "common": {"shortcode": "224433", "lang": ["en", "fr"]},
+                "rapidpro": {"reporter_group": "reporters", "is_on": True},
+            },
+        )
+
+        # so concurrent updates to other keys aren't overwritten
+        org.set_config("rapidpro.reporter_group", "others")
+        self.org.set_configs({"shortcode": "1234", "rapidpro.is_on": False})
+
+        org.refresh_from_db()
+        self.assertEqual(
+            org.config,
+            {
+                "common": {"shortcode": "1234", "lang": ["en", "fr"]},
+                "rapidpro": {"reporter_group": "others", "is_on": False},
+            },
+        )
+
+        # works for orgs without any config too, and for orgs which haven't been saved yet
+        Org.objects.filter(pk=org.pk).update(config={})
+        org.refresh_from_db()
+        org.set_configs({"shortcode": "4321"})
+        org.refresh_from_db()
+        self.assertEqual(org.config, {"common": {"shortcode": "4321"}})
+
+        new_org = Org(name="Kenya", created_by=self.admin, modified_by=self.admin)
+        new_org.set_configs({"shortcode": "5555"})
+        self.assertEqual(Org.objects.get(pk=new_org.pk).get_config("shortcode"), "5555")
+
     def test_set_config_no_commit(self):
         """If commit=False is passed to Org.set_config, changes should not be saved."""
         self.org.set_config("test", "hello", commit=False)
@@ -1160,26 +1551,64 @@ class OrgTest(DashTest):
 
         response = self.client.get(chooser_url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.context["orgs"]), 1)
-        self.assertTrue(self.org in response.context["orgs"])
-        self.assertEqual(response.context["orgs"][0].host, "http://uganda.ureport.io")
+        self.assertEqual(
+            response.context["orgs"],
+            [{"id": self.org.id, "name": "uganda", "logo_url": None, "host": "http://uganda.ureport.io"}],
+        )
+        self.assertContains(response, '<a href="http://uganda.ureport.io">uganda</a>', html=True)
 
-        self.org2 = self.create_org("nigeria", self.admin)
+        # the payload is cached
+        with self.assertNumQueries(0):
+            self.assertEqual(Org.get_chooser_orgs()["orgs"], response.context["orgs"])
+
+        # but rebuilt when org changes are committed
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.org2 = self.create_org("nigeria", self.admin)
+
+            response = self.client.get(chooser_url)
+            self.assertEqual([o["id"] for o in response.context["orgs"]], [self.org.id])
+
+        for callback in callbacks:
+            callback()
 
         response = self.client.get(chooser_url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.context["orgs"]), 2)
-        self.assertTrue(self.org in response.context["orgs"])
-        self.assertTrue(self.org2 in response.context["orgs"])
+        self.assertEqual([o["id"] for o in response.context["orgs"]], [self.org2.id, self.org.id])
+        self.assertEqual(response.context["orgs"][0]["host"], "http://nigeria.ureport.io")
 
         self.org2.is_active = False
-        self.org2.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.org2.save()
 
         response = self.client.get(chooser_url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.context["orgs"]), 1)
-        self.assertTrue(self.org in response.context["orgs"])
-        self.assertFalse(self.org2 in response.context["orgs"])
+        self.assertEqual([o["id"] for o in response.context["orgs"]], [self.org.id])
+
+        # or when settings which affect host links change
+        with self.settings(HOSTNAME="ureport.in"):
+            response = self.client.get(chooser_url)
+            self.assertEqual(response.context["orgs"][0]["host"], "http://uganda.ureport.in")
+
+        # the list can also be cached as a fragment, keyed by the payload version
+        with self.settings(SITE_CHOOSER_FRAGMENT_CACHE_TIME=60):
+            response = self.client.get(chooser_url)
+            self.assertContains(response, "http://uganda.ureport.io")
+
+            # change the payload without changing its version, so the stale fragment is served
+            chooser = Org.get_chooser_orgs()
+            chooser["orgs"][0]["name"] = "Ouganda"
+            cache.set("org:chooser", json.dumps(chooser), 60)
+
+            response = self.client.get(chooser_url)
+            self.assertNotContains(response, "Ouganda")
+
+            # until the payload is rebuilt with a new version
+            self.org.name = "Ouganda"
+            with self.captureOnCommitCallbacks(execute=True):
+                self.org.save()
+
+            response = self.client.get(chooser_url)
+            self.assertContains(response, "Ouganda")
 
     def test_invitation_model(self):
         invitation = Invitation.objects.create(
@@ -1668,6 +2097,16 @@ def test_org_task_3(org, prev_started_on, started_on, prev_results):
     return test_over_time_window(org, prev_started_on, started_on, prev_results)
 
 
+@org_task("test-task-4", lock_timeout=1, heartbeat=True)
+def test_org_task_4(org, prev_started_on, started_on):
+    return test_over_time_window(org, prev_started_on, started_on)
+
+
+@org_task("test-task-5", coalesce=True)
+def test_org_task_5(org, prev_started_on, started_on, prev_results):
+    return test_over_time_window(org, prev_started_on, started_on, prev_results)
+
+
 class OrgTaskTest(DashTest):
     def setUp(self):
         super(OrgTaskTest, self).setUp()
@@ -1885,6 +2324,250 @@ class OrgTaskTest(DashTest):
 
         self.assertTrue(TaskState.objects.get(org=self.org, task_key="test-task-2").is_failing)
 
+    @patch("test_runner.tests.test_over_time_window")
+    def test_org_task_lock_heartbeat(self, mock_over_time_window):
+        r = get_valkey_connection()
+        key = TaskState.get_lock_key(self.org, "test-task-4")
+
+        def outlive_lock(org, prev_started_on, started_on):
+            time.sleep(1.5)
+            self.assertTrue(r.exists(key))  # lock has been renewed past its 1 second timeout
+            return {}
+
+        mock_over_time_window.side_effect = outlive_lock
+
+        test_org_task_4(self.org.id)
+
+        self.assertFalse(r.exists(key))
+        self.assertFalse(TaskState.objects.get(org=self.org, task_key="test-task-4").is_failing)
+
+        def lose_lock(org, prev_started_on, started_on):
+            self.assertFalse(is_org_task_lock_lost())
+
+            r.set(key, "other-worker")  # simulate the lock expiring and being taken by another worker
+            time.sleep(0.6)
+
+            self.assertTrue(is_org_task_lock_lost())  # so that a long-running task can stop early
+            return {}
+
+        mock_over_time_window.side_effect = lose_lock
+
+        with self.assertLogs("dash.orgs.tasks", level="ERROR") as logs:
+            test_org_task_4(self.org.id)
+
+        self.assertIn("Lock for task test-task-4 for org #%d was lost" % self.org.id, logs.output[0])
+        self.assertEqual(r.get(key), b"other-worker")  # other worker's lock is left alone
+        self.assertFalse(is_org_task_lock_lost())
+
+    @patch("test_runner.tests.test_over_time_window")
+    def test_org_task_state_writes(self, mock_over_time_window):
+        mock_over_time_window.return_value = {"foo": "bar"}
+
+        def num_writes(task):
+            with CaptureQueriesContext(connection) as ctx:
+                task(self.org.id)
+
+            return len([q for q in ctx.captured_queries if q["sql"].startswith(("INSERT", "UPDATE"))])
+
+        # the start of a run is a single upsert whether or not the state exists, and the end a single update
+        self.assertEqual(num_writes(test_org_task_2), 2)
+        self.assertEqual(num_writes(test_org_task_2), 2)
+        self.assertEqual(TaskState.objects.filter(org=self.org, task_key="test-task-2").count(), 1)
+
+        # a coalesced task writes its state once, at the end of the run
+        self.assertEqual(num_writes(test_org_task_5), 1)
+
+        state1 = TaskState.objects.get(org=self.org, task_key="test-task-5")
+        self.assertIsNotNone(state1.started_on)
+        self.assertGreater(state1.ended_on, state1.started_on)
+        self.assertEqual(state1.last_successfully_started_on, state1.started_on)
+        self.assertEqual(state1.get_last_results(), {"foo": "bar"})
+        self.assertFalse(state1.is_failing)
+
+        self.assertEqual(num_writes(test_org_task_5), 1)
+
+        state2 = TaskState.objects.get(org=self.org, task_key="test-task-5")
+        self.assertGreater(state2.started_on, state1.started_on)
+
+        mock_over_time_window.assert_called_with(self.org, state1.started_on, state2.started_on, {"foo": "bar"})
+
+        # a failed coalesced run keeps the previous successful start and results
+        mock_over_time_window.side_effect = ValueError("DOH!")
+
+        self.assertRaises(ValueError, test_org_task_5, self.org.id)
+
+        state3 = TaskState.objects.get(org=self.org, task_key="test-task-5")
+        self.assertGreater(state3.started_on, state2.started_on)
+        self.assertEqual(state3.last_successfully_started_on, state2.started_on)
+        self.assertEqual(state3.get_last_results(), {"foo": "bar"})
+        self.assertTrue(state3.is_failing)
+
+        # and a disabled coalesced task isn't run or written
+        TaskState.objects.filter(org=self.org, task_key="test-task-5").update(is_disabled=True)
+        mock_over_time_window.reset_mock()
+
+        self.assertEqual(num_writes(test_org_task_5), 0)
+
+        mock_over_time_window.assert_not_called()
+        self.assertEqual(TaskState.objects.get(org=self.org, task_key="test-task-5").started_on, state3.started_on)
+
+    def test_task_state_upsert(self):
+        now = timezone.now()
+
+        state = TaskState.upsert(self.org, "test-task-1", started_on=now, ended_on=None)
+        self.assertEqual((state.org_id, state.task_key, state.started_on), (self.org.id, "test-task-1", now))
+        self.assertFalse(state.is_failing)
+
+        # upserting again updates only the given fields
+        TaskState.objects.filter(id=state.id).update(last_results='{"foo": 1}')
+
+        state = TaskState.upsert(self.org, "test-task-1", started_on=now + timedelta(seconds=1), is_failing=True)
+        self.assertEqual(state.started_on, now + timedelta(seconds=1))
+        self.assertEqual(state.get_last_results(), {"foo": 1})
+        self.assertTrue(state.is_failing)
+
+        # unless the task is disabled
+        TaskState.objects.filter(id=state.id).update(is_disabled=True)
+
+        self.assertIsNone(TaskState.upsert(self.org, "test-task-1", started_on=now))
+        self.assertEqual(TaskState.objects.get(id=state.id).started_on, now + timedelta(seconds=1))
+
+    @patch("test_runner.tests.test_over_time_window")
+    def test_trigger_org_task(self, mock_over_time_window):
+        mock_over_time_window.return_value = {}
+
+        org2 = self.create_org("nigeria", self.admin)
+        org3 = self.create_org("kenya", self.admin)
+        org4 = self.create_org("rwanda", self.admin)
+        org4.is_active = False
+        org4.save(update_fields=("is_active",))
+
+        # sub-tasks are published in groups of chunk_size, and only for active orgs
+        with patch("dash.orgs.tasks.group", wraps=celery_group) as mock_group:
+            trigger_org_task("test_runner.tests.test_org_task_2", chunk_size=2)
+
+        self.assertEqual([len(c.args[0]) for c in mock_group.call_args_list], [2, 1])
+        self.assertEqual(
+            set(TaskState.objects.filter(task_key="test-task-2").values_list("org_id", flat=True)),
+            {self.org.id, org2.id, org3.id},
+        )
+
+        # sub-tasks can be staggered over a window of time
+        with patch("dash.orgs.tasks.group", wraps=celery_group) as mock_group:
+            trigger_org_task("test_runner.tests.test_org_task_2", queue="sync", spread=60)
+
+        sigs = mock_group.call_args.args[0]
+        self.assertEqual([s.args for s in sigs], [[self.org.id], [org2.id], [org3.id]])
+        self.assertEqual([s.options for s in sigs], [{"queue": "sync", "countdown": c} for c in (0, 20, 40)])
+
+    @patch("test_runner.tests.test_over_time_window")
+    def test_trigger_org_task_skips_locked_and_disabled(self, mock_over_time_window):
+        mock_over_time_window.return_value = {}
+
+        org2 = self.create_org("nigeria", self.admin)
+        org3 = self.create_org("kenya", self.admin)
+        TaskState.objects.create(org=org3, task_key="test-task-2", is_disabled=True)
+
+        r = get_valkey_connection()
+        lock = r.lock(TaskState.get_lock_key(org2, "test-task-2"), timeout=60)
+        lock.acquire(blocking=False)
+
+        try:
+            with patch("dash.orgs.tasks.group", wraps=celery_group) as mock_group:
+                trigger_org_task("test_runner.tests.test_org_task_2")
+        finally:
+            lock.release()
+
+        # only the org which isn't running or disabled is sent a sub-task
+        self.assertEqual([s.args for s in mock_group.call_args.args[0]], [[self.org.id]])
+        mock_over_time_window.assert_called_once()
+
+        # tasks which aren't org tasks have nothing to pre-filter by
+        with patch("dash.orgs.tasks.signature") as mock_signature, patch("dash.orgs.tasks.group"):
+            trigger_org_task("test_runner.tests.some_other_task")
+
+        self.assertEqual(
+            [c.kwargs["args"] for c in mock_signature.call_args_list], [[self.org.id], [org2.id], [org3.id]]
+        )
+
+    def test_trigger_org_task_adaptive(self):
+        now = timezone.now()
+        org2 = self.create_org("nigeria", self.admin)
+        org3 = self.create_org("kenya", self.admin)
+        org4 = self.create_org("rwanda", self.admin)
+        org5 = self.create_org("burundi", self.admin)
+
+        def create_state(org, started_mins_ago, mins_taken, results, **kwargs):
+            started_on = now - timedelta(minutes=started_mins_ago)
+            return TaskState.objects.create(
+                org=org,
+                task_key="test-task-2",
+                started_on=started_on,
+                ended_on=started_on + timedelta(minutes=mins_taken),
+                last_successfully_started_on=started_on,
+                last_results=json.dumps(results),
+                **kwargs,
+            )
+
+        create_state(org2, 30, 20, {"created": 1, "updated": 2, "deleted": 0})  # slow
+        # quiet and ran recently - ignored counts and sync metrics aren't changes
+        state3 = create_state(
+            org3,
+            5,
+            1,
+            {
+                "created": 0,
+                "updated": 0,
+                "deleted": 0,
+                "ignored": 250,
+                "metrics": {"elapsed": 1.5, "queries": 2, "fetches": 1, "times": {"fetch": 0.5, "write": 0.5}},
+            },
+        )
+        create_state(org4, 5, 1, {"contacts": {"created": 5}, "complete": True})
+        state5 = create_state(org5, 120, 1, {"created": 0})  # quiet but hasn't run for a while
+
+        self.assertEqual(state3.get_num_changes(), 0)
+        self.assertEqual(state3.get_num_changes(("ignored",)), 250)
+        self.assertEqual(state5.get_num_changes(), 0)
+        self.assertIsNone(TaskState(org=org5, task_key="test-task-2", last_results='{"ok": true}').get_num_changes())
+
+        def trigger(**kwargs):
+            with patch("dash.orgs.tasks.signature") as mock_signature, patch("dash.orgs.tasks.group"):
+                trigger_org_task("test_runner.tests.test_org_task_2", adaptive=True, **kwargs)
+
+            return [(c.kwargs["args"][0], c.kwargs["queue"]) for c in mock_signature.call_args_list]
+
+        # orgs which have never run go first, then by number of changes, and recently quiet orgs are skipped
+        self.assertEqual(
+            trigger(slow_queue="slow"),
+            [(self.org.id, "celery"), (org4.id, "celery"), (org2.id, "slow"), (org5.id, "celery")],
+        )
+
+        # slow orgs stay on the main queue if there's no slow queue, and quiet interval and slow threshold can be changed
+        self.assertEqual(
+            trigger(quiet_interval=60, slow_threshold=60 * 60),
+            [
+                (self.org.id, "celery"),
+                (org4.id, "celery"),
+                (org2.id, "celery"),
+                (org3.id, "celery"),
+                (org5.id, "celery"),
+            ],
+        )
+
+        # a failing quiet org isn't backed off
+        TaskState.objects.filter(org=org3).update(is_failing=True)
+
+        self.assertIn((org3.id, "slow"), trigger(slow_queue="slow", slow_threshold=30))
+
+        # org tasks can declare which keys of their results count as changes
+        TaskState.objects.filter(org=org3).update(is_failing=False)
+
+        with patch.object(test_org_task_2, "org_task_change_keys", ("ignored",)):
+            self.assertEqual(trigger()[:2], [(self.org.id, "celery"), (org3.id, "celery")])
+
+        self.assertEqual(test_org_task_2.org_task_change_keys, ("created", "updated", "deleted"))
+
 
 class TaskCRUDLTest(DashTest):
     def setUp(self):